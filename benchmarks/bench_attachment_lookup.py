@@ -0,0 +1,114 @@
+"""Measures attachment lookups by digest and by URL before and after migration v8.
+
+Fills an attachment table with ``--rows`` rows at schema v7, where the digest is a hex
+TEXT primary key, times lookups, migrates to the current schema, where it's binary and
+URLs have a table of their own since v9, and times them again.
+Works on SQLite and, given a postgres:// URL of an empty database, on Postgres.
+
+Run it from the repository root, with maubot and its dependencies installed:
+
+    PYTHONPATH=. python benchmarks/bench_attachment_lookup.py [--rows 1000000] [--database sqlite:/tmp/bench.db]
+"""
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import time
+
+from mautrix.util.async_db import Database
+
+from urldownload.DBManager import DBManager
+from urldownload.dataclass.Attachment import Attachment
+from urldownload.migrations import upgrade_table
+
+BATCH_SIZE = 10_000
+V7 = 7
+# What DBManager selected before v8
+V7_QUERY = """
+SELECT
+    sha512sum, uri, mimetype, size, thumbnail_uri, width, height, duration,
+    thumbnail_width, thumbnail_height, thumbnail_size, url, etag, last_modified,
+    content_length
+FROM attachment
+"""
+
+
+def digest(n: int) -> str:
+    return hashlib.sha512(n.to_bytes(8, "big")).hexdigest()
+
+
+async def fill(db: Database, rows: int) -> None:
+    q = """
+    INSERT INTO attachment (sha512sum, uri, mimetype, size, url)
+    VALUES ($1, $2, $3, $4, $5)
+    """
+    for start in range(0, rows, BATCH_SIZE):
+        await db.executemany(q, [
+            (digest(n), f"mxc://example.com/{n}", "video/mp4", n, f"https://example.com/{n}.mp4")
+            for n in range(start, min(start + BATCH_SIZE, rows))
+        ])
+
+
+async def measure(name: str, lookup, keys: list) -> None:
+    started = time.perf_counter()
+    for key in keys:
+        assert await lookup(key) is not None
+    elapsed = time.perf_counter() - started
+    print(f"{name:<28} {elapsed / len(keys) * 1e6:8.1f} µs per lookup")
+
+
+def print_size(url: str) -> None:
+    if url.startswith("sqlite:"):
+        print(f"{'database file':<28} {os.path.getsize(url[len('sqlite:'):]) / 1e6:8.1f} MB")
+
+
+async def main(url: str, rows: int, lookups: int) -> None:
+    if url.startswith("sqlite:") and os.path.exists(url[len("sqlite:"):]):
+        os.remove(url[len("sqlite:"):])
+    sample = random.sample(range(rows), min(lookups, rows))
+
+    upgrades = upgrade_table.upgrades
+    upgrade_table.upgrades = upgrades[:V7]
+    db = Database.create(url, upgrade_table=upgrade_table)
+    await db.start()
+    started = time.perf_counter()
+    await fill(db, rows)
+    print(f"Filled {rows} rows in {time.perf_counter() - started:.1f} s")
+
+    async def by_digest_v7(sha512sum):
+        rows = await db.fetch(V7_QUERY + "WHERE sha512sum = $1", sha512sum)
+        return Attachment.from_row(rows[0]) if rows else None
+
+    async def by_url_v7(source):
+        rows = await db.fetch(V7_QUERY + "WHERE url = $1 LIMIT 1", source)
+        return Attachment.from_row(rows[0]) if rows else None
+
+    await measure("v7 by digest (hex TEXT)", by_digest_v7, [digest(n) for n in sample])
+    await measure("v7 by URL", by_url_v7, [f"https://example.com/{n}.mp4" for n in sample])
+    await db.stop()
+    print_size(url)
+
+    upgrade_table.upgrades = upgrades
+    started = time.perf_counter()
+    db = Database.create(url, upgrade_table=upgrade_table)
+    await db.start()
+    print(f"Migrated to v{len(upgrades)} in {time.perf_counter() - started:.1f} s")
+
+    dbm = DBManager(db, logging.getLogger("benchmark"), cache_size=0)
+    await measure("current by digest (binary)", dbm.get_attachment, [digest(n) for n in sample])
+    await measure("current by URL", dbm.get_attachment_by_url, [f"https://example.com/{n}.mp4" for n in sample])
+    if db.scheme.value == "sqlite":
+        await db.execute("VACUUM")
+    await db.stop()
+    print_size(url)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database", default="sqlite:/tmp/urldownload-bench.db")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--lookups", type=int, default=10_000)
+    args = parser.parse_args()
+    asyncio.run(main(args.database, args.rows, args.lookups))
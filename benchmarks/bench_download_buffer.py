@@ -0,0 +1,93 @@
+"""Compares reading a download into bytes with ``+=`` against DownloadBuffer.
+
+Serves bodies of 10 MB, 100 MB and 1 GB from a local aiohttp server and reads them the
+old way (``iter_chunked(8192)`` and ``media_data += chunk``) and the new way (large
+chunks written into a DownloadBuffer). The old way is quadratic, so it's skipped for
+bodies above ``--old-max`` bytes unless that's raised.
+
+Run it from the repository root, with maubot and its dependencies installed:
+
+    PYTHONPATH=. python benchmarks/bench_download_buffer.py [--sizes 10000000,100000000,1000000000]
+"""
+import argparse
+import asyncio
+import time
+
+import aiohttp
+from aiohttp import web
+
+from urldownload.DownloadBuffer import DownloadBuffer
+
+PORT = 8781
+
+
+async def serve(request: web.Request) -> web.StreamResponse:
+    size = int(request.match_info["size"])
+    response = web.StreamResponse()
+    response.content_length = size
+    await response.prepare(request)
+    block = b"\0" * (1024 * 1024)
+    sent = 0
+    while sent < size:
+        await response.write(block[:size - sent])
+        sent += min(len(block), size - sent)
+    await response.write_eof()
+    return response
+
+
+async def read_old(session: aiohttp.ClientSession, url: str) -> int:
+    media_data = b""
+    async with session.get(url) as response:
+        async for chunk in response.content.iter_chunked(8192):
+            media_data += chunk
+    return len(media_data)
+
+
+async def read_new(session: aiohttp.ClientSession, url: str, chunk_size: int) -> int:
+    buffer = DownloadBuffer()
+    try:
+        async with session.get(url) as response:
+            chunks = response.content.iter_chunked(chunk_size) if chunk_size > 0 else response.content.iter_any()
+            async for chunk in chunks:
+                await buffer.write(chunk)
+        # The digest is part of the work, it's updated while writing
+        assert buffer.sha512sum
+        return buffer.size
+    finally:
+        buffer.close()
+
+
+async def measure(name: str, size: int, read) -> None:
+    started = time.perf_counter()
+    received = await read()
+    elapsed = time.perf_counter() - started
+    assert received == size
+    print(f"{name:>4} {size:>13} bytes {elapsed:8.2f} s {size / elapsed / 1e6:9.1f} MB/s")
+
+
+async def main(sizes: list[int], old_max: int, chunk_size: int) -> None:
+    app = web.Application()
+    app.router.add_get("/{size}", serve)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+    try:
+        async with aiohttp.ClientSession() as session:
+            for size in sizes:
+                url = f"http://127.0.0.1:{PORT}/{size}"
+                if size <= old_max:
+                    await measure("old", size, lambda: read_old(session, url))
+                else:
+                    print(f" old {size:>13} bytes  skipped, raise --old-max to run it")
+                await measure("new", size, lambda: read_new(session, url, chunk_size))
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10000000,100000000,1000000000")
+    parser.add_argument("--old-max", type=int, default=10_000_000)
+    parser.add_argument("--chunk-size", type=int, default=1024 * 1024, help="0 uses iter_any")
+    args = parser.parse_args()
+    asyncio.run(main([int(size) for size in args.sizes.split(",")], args.old_max, args.chunk_size))
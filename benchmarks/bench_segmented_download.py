@@ -0,0 +1,127 @@
+"""Compares downloading a file over one connection against segmented range downloads.
+
+A local aiohttp server serves a file with byte range support and limits every connection
+to ``--rate`` bytes per second, like a long-haul link limited by its TCP window. The file
+is downloaded by the plugin's own download_with_progress with 1 to 8 parts.
+
+Run it from the repository root, with maubot and its dependencies installed:
+
+    PYTHONPATH=. python benchmarks/bench_segmented_download.py [--size 100000000] [--rate 10000000]
+"""
+import argparse
+import asyncio
+import re
+import time
+
+import aiohttp
+from aiohttp import web
+
+from urldownload import URLDownloadBot
+from urldownload.CircuitBreaker import CircuitBreaker
+from urldownload.HostRateLimiter import HostRateLimiter
+from urldownload.MemoryBudget import MemoryBudget
+from urldownload.ThroughputWatchdog import HostThroughput
+
+PORT = 8782
+ETAG = '"benchmark"'
+BLOCK_SIZE = 64 * 1024
+
+
+def create_server(size: int, rate: float) -> web.Application:
+    block = b"\0" * BLOCK_SIZE
+
+    async def serve(request: web.Request) -> web.StreamResponse:
+        start, end = 0, size - 1
+        response = web.StreamResponse(headers={"Accept-Ranges": "bytes", "ETag": ETAG})
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", request.headers.get("Range", ""))
+        if match and request.headers.get("If-Range", ETAG) == ETAG:
+            start, end = int(match.group(1)), int(match.group(2) or size - 1)
+            response.set_status(206)
+            response.headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        response.content_length = end - start + 1
+        await response.prepare(request)
+        remaining = end - start + 1
+        started = time.monotonic()
+        sent = 0
+        try:
+            while remaining > 0:
+                await response.write(block[:remaining])
+                sent += min(BLOCK_SIZE, remaining)
+                remaining -= BLOCK_SIZE
+                # Throttled per connection
+                delay = sent / rate - (time.monotonic() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await response.write_eof()
+        except ConnectionResetError:
+            pass  # the client drops the full response once it has read the first part
+        return response
+
+    app = web.Application()
+    app.router.add_get("/file", serve)
+    return app
+
+
+def create_bot(session: aiohttp.ClientSession) -> URLDownloadBot:
+    # Only what download_with_progress needs, without a maubot instance around it
+    bot = object.__new__(URLDownloadBot)
+    bot.config = {
+        "download_chunk_size": 1024 * 1024,
+        "mimetype_regex": ".*",
+        "extension_regex": ".*",
+        "spool.threshold": 0,
+        "spool.directory": "",
+        "memory_budget.wait_timeout": 5,
+        "watchdog.min_rate": 0,
+        "watchdog.relative_min_rate": 0,
+        "watchdog.stall_time": 60,
+        "watchdog.deadline": 3600,
+        "resume.max_attempts": 0,
+        "resume.delay": 1,
+        "rate_limit.max_retries": 0,
+    }
+    bot.session = session
+    bot.memory_budget = MemoryBudget(0)
+    bot.host_throughput = HostThroughput()
+    bot.circuit_breaker = CircuitBreaker(5, 60)
+    bot.rate_limiter = HostRateLimiter(0, 1)
+    return bot
+
+
+async def download(bot: URLDownloadBot, url: str, segments: int) -> str:
+    response = await bot.request(url, {}, None, False)
+    async with response:
+        file_info = await bot.get_file_info(response, url, None, False)
+        buffer = await bot.download_with_progress(response, url, file_info, None, False, file_info["size"], None, segments)
+    try:
+        return buffer.sha512sum
+    finally:
+        buffer.close()
+
+
+async def main(size: int, rate: float, parts: list[int]) -> None:
+    runner = web.AppRunner(create_server(size, rate))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+    try:
+        async with aiohttp.ClientSession() as session:
+            bot = create_bot(session)
+            url = f"http://127.0.0.1:{PORT}/file"
+            digests = set()
+            for segments in parts:
+                started = time.perf_counter()
+                digests.add(await download(bot, url, segments))
+                elapsed = time.perf_counter() - started
+                print(f"{segments} part(s) {size:>12} bytes {elapsed:8.2f} s {size / elapsed / 1e6:8.1f} MB/s")
+            assert len(digests) == 1, "digests differ"
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=100_000_000)
+    parser.add_argument("--rate", type=float, default=10_000_000, help="bytes per second and connection")
+    parser.add_argument("--parts", default="1,2,4,8")
+    args = parser.parse_args()
+    asyncio.run(main(args.size, args.rate, [int(n) for n in args.parts.split(",")]))
@@ -0,0 +1,36 @@
+import asyncio
+import logging
+
+from mautrix.util.async_db import Database
+
+from urldownload.DBManager import DBManager
+from urldownload.dataclass.Attachment import Attachment
+from urldownload.migrations import upgrade_table
+
+
+def test_validators_by_url(tmp_path):
+    # The same file from two URLs, each with its own validators, found again by either URL
+    # after the flush and after the validators of one of them changed
+    async def run():
+        db = Database.create(f"sqlite:{tmp_path / 'url.db'}", upgrade_table=upgrade_table)
+        await db.start()
+        dbm = DBManager(db, logging.getLogger("test"), cache_size=0)
+        attachment = Attachment(sha512sum="ab" * 64, uri="mxc://example.com/a", mimetype="image/png", size=1,
+                                url="https://a.example.com/a.png", etag='"a"')
+        await dbm.store_attachment(attachment)
+        await dbm.store_url(attachment)
+        second = Attachment(**{**attachment.__dict__, "url": "https://b.example.com/b.png", "etag": None,
+                               "last_modified": "Mon, 01 Jan 2024 00:00:00 GMT"})
+        await dbm.store_url(second)
+        await dbm.flush()
+        await dbm.store_url(Attachment(**{**attachment.__dict__, "etag": '"a2"'}))
+        await dbm.flush()
+
+        found = [await dbm.get_attachment_by_url(url) for url in (attachment.url, second.url, "https://c.example.com/")]
+        await db.stop()
+        return found
+
+    first, second, missing = asyncio.run(run())
+    assert (first.uri, first.etag, first.last_modified) == ("mxc://example.com/a", '"a2"', None)
+    assert (second.uri, second.etag, second.last_modified) == ("mxc://example.com/a", None, "Mon, 01 Jan 2024 00:00:00 GMT")
+    assert missing is None
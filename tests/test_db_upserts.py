@@ -0,0 +1,71 @@
+import asyncio
+import logging
+
+from mautrix.util.async_db import Database
+
+from urldownload.DBManager import DBManager
+from urldownload.dataclass.Attachment import Attachment
+from urldownload.migrations import upgrade_table
+
+ROOMS = 50
+WRITERS = 4
+
+
+async def open_database(path) -> Database:
+    db = Database.create(f"sqlite:{path}", upgrade_table=upgrade_table)
+    await db.start()
+    return db
+
+
+def test_parallel_status_writes(tmp_path):
+    # Several managers, like several plugin instances sharing a database, set both flags
+    # of rooms that don't exist yet at the same time. Neither flag may be lost.
+    async def run():
+        db = await open_database(tmp_path / "status.db")
+        managers = [DBManager(db, logging.getLogger("test")) for _ in range(WRITERS)]
+        writes = []
+        for room in range(ROOMS):
+            room_id = f"!room{room}:example.com"
+            for i, dbm in enumerate(managers):
+                if i % 2 == 0:
+                    writes.append(dbm.set_enabled_in_room(room_id, True))
+                else:
+                    writes.append(dbm.set_debug_in_room(room_id, True))
+        await asyncio.gather(*writes)
+
+        fresh = DBManager(db, logging.getLogger("test"))
+        await fresh.load_room_status()
+        await db.stop()
+        return fresh.room_status
+
+    status = asyncio.run(run())
+    assert len(status) == ROOMS
+    assert all(flags == (True, True) for flags in status.values())
+
+
+def test_parallel_attachment_writes(tmp_path):
+    # The same file stored and flushed by several managers at once ends up as one row
+    async def run():
+        db = await open_database(tmp_path / "attachment.db")
+        managers = [DBManager(db, logging.getLogger("test"), max_pending=1000) for _ in range(WRITERS)]
+        for i, dbm in enumerate(managers):
+            for n in range(ROOMS):
+                await dbm.store_attachment(Attachment(
+                    sha512sum=f"{n:0128x}",
+                    uri=f"mxc://example.com/{n}-{i}",
+                    mimetype="image/png",
+                    size=n,
+                    url=f"https://example.com/{n}.png"
+                ))
+                await dbm.record_usage(f"{n:0128x}", "!room:example.com")
+        await asyncio.gather(*(dbm.flush() for dbm in managers))
+
+        rows = await db.fetch("SELECT hit_count FROM attachment")
+        room_hits = await db.fetch("SELECT hit_count FROM attachment_room")
+        await db.stop()
+        return rows, room_hits
+
+    rows, room_hits = asyncio.run(run())
+    assert len(rows) == ROOMS
+    assert sum(row["hit_count"] for row in rows) == ROOMS * WRITERS
+    assert [row["hit_count"] for row in room_hits] == [WRITERS] * ROOMS
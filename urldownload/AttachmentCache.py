@@ -0,0 +1,65 @@
+from collections import OrderedDict
+
+from urldownload.dataclass.Attachment import Attachment
+
+
+class AttachmentCache:
+    """Bounded in-memory LRU cache of attachments, looked up by digest or by source URL.
+
+    URLs have entries of their own, because the same file can be served by several URLs
+    with different validators. Removing an attachment drops the entries of its URLs too.
+    """
+    max_size: int
+    entries: OrderedDict[str, Attachment]
+    urls: OrderedDict[str, Attachment]
+    hits: int
+    misses: int
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.urls = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, sha512sum: str) -> Attachment | None:
+        return self._get(self.entries, sha512sum)
+
+    def get_by_url(self, url: str) -> Attachment | None:
+        return self._get(self.urls, url)
+
+    def add(self, attachment: Attachment) -> None:
+        self._add(self.entries, attachment.sha512sum, attachment)
+
+    def add_for_url(self, attachment: Attachment) -> None:
+        # The attachment as it was last downloaded from its URL, with that URL's validators
+        self._add(self.urls, attachment.url, attachment)
+
+    def remove(self, sha512sum: str) -> None:
+        self.entries.pop(sha512sum, None)
+        for url in [url for url, attachment in self.urls.items() if attachment.sha512sum == sha512sum]:
+            del self.urls[url]
+
+    def _get(self, entries: OrderedDict[str, Attachment], key: str) -> Attachment | None:
+        attachment = entries.get(key)
+        if attachment is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entries.move_to_end(key)
+        return attachment
+
+    def _add(self, entries: OrderedDict[str, Attachment], key: str, attachment: Attachment) -> None:
+        if self.max_size <= 0 or not key:
+            return
+        entries[key] = attachment
+        entries.move_to_end(key)
+        while len(entries) > self.max_size:
+            entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.urls.clear()
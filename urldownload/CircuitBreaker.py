@@ -0,0 +1,72 @@
+import time
+
+
+class CircuitOpen(Exception):
+    """Raised when a request is refused because the circuit of its host is open."""
+
+
+class HostCircuit:
+    failures: int
+    opened_at: float | None
+    probe_started_at: float | None
+
+    def __init__(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started_at = None
+
+
+class CircuitBreaker:
+    """Per-host circuit breaker that fails fast for origins that keep failing.
+
+    After ``failure_threshold`` consecutive failures a host's circuit opens and requests
+    to it are refused. Once ``reset_timeout`` seconds have passed it is half-open, and a
+    single probe request is let through: its success closes the circuit again, its
+    failure keeps it open for another ``reset_timeout``.
+    """
+    failure_threshold: int
+    reset_timeout: float
+    circuits: dict[str, HostCircuit]
+
+    def __init__(self, failure_threshold: int, reset_timeout: float) -> None:
+        self.failure_threshold = max(failure_threshold, 1)
+        self.reset_timeout = reset_timeout
+        self.circuits = {}
+
+    def allow(self, host: str) -> bool:
+        circuit = self.circuits.get(host)
+        if circuit is None or circuit.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - circuit.opened_at < self.reset_timeout:
+            return False
+        # Half-open: let one probe through, or another one if the last probe never reported back
+        if circuit.probe_started_at is None or now - circuit.probe_started_at >= self.reset_timeout:
+            circuit.probe_started_at = now
+            return True
+        return False
+
+    def record_success(self, host: str) -> None:
+        self.circuits.pop(host, None)
+
+    def record_failure(self, host: str) -> None:
+        circuit = self.circuits.setdefault(host, HostCircuit())
+        circuit.failures += 1
+        if circuit.opened_at is not None or circuit.failures >= self.failure_threshold:
+            circuit.opened_at = time.monotonic()
+            circuit.probe_started_at = None
+
+    def get_state(self, host: str) -> str:
+        circuit = self.circuits.get(host)
+        if circuit is None or circuit.opened_at is None:
+            return "closed"
+        if time.monotonic() - circuit.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def get_tripped_hosts(self) -> dict[str, str]:
+        return {
+            host: self.get_state(host)
+            for host, circuit in self.circuits.items()
+            if circuit.opened_at is not None
+        }
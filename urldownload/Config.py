@@ -11,3 +11,46 @@ class Config(BaseProxyConfig):
         helper.copy("url_regex")
         helper.copy("mimetype_regex")
         helper.copy("extension_regex")
+        helper.copy("download_chunk_size")
+        helper.copy("http.limit")
+        helper.copy("http.limit_per_host")
+        helper.copy("http.dns_cache_ttl")
+        helper.copy("http.keepalive_timeout")
+        helper.copy("concurrency.per_message")
+        helper.copy("concurrency.total")
+        helper.copy("queue.workers")
+        helper.copy("queue.max_size")
+        helper.copy("queue.drain_timeout")
+        helper.copy("queue.max_attempts")
+        helper.copy("spool.threshold")
+        helper.copy("spool.directory")
+        helper.copy("stream_upload.threshold")
+        helper.copy("negative_cache.max_size")
+        helper.copy("negative_cache.persist")
+        helper.copy("negative_cache.ttl.filtered")
+        helper.copy("negative_cache.ttl.too_large")
+        helper.copy("negative_cache.ttl.rate_limited")
+        helper.copy("negative_cache.ttl.http_error")
+        helper.copy("negative_cache.ttl.failed")
+        helper.copy("media_repo_refresh_interval")
+        helper.copy("rate_limit.requests_per_second")
+        helper.copy("rate_limit.burst")
+        helper.copy("rate_limit.max_retries")
+        helper.copy("rate_limit.default_delay")
+        helper.copy("rate_limit.max_delay")
+        helper.copy("circuit_breaker.failure_threshold")
+        helper.copy("circuit_breaker.reset_timeout")
+        helper.copy("memory_budget.max_bytes")
+        helper.copy("memory_budget.wait_timeout")
+        helper.copy("watchdog.min_rate")
+        helper.copy("watchdog.relative_min_rate")
+        helper.copy("watchdog.stall_time")
+        helper.copy("watchdog.deadline")
+        helper.copy("segmented_download.min_size")
+        helper.copy("segmented_download.connections")
+        helper.copy("segmented_download.hosts")
+        helper.copy("resume.max_attempts")
+        helper.copy("resume.delay")
+        helper.copy("write_behind.flush_interval")
+        helper.copy("write_behind.max_pending")
+        helper.copy("attachment_cache.max_size")
@@ -0,0 +1,61 @@
+import io
+import re
+
+from tinytag.tinytag import TinyTag, ID3, Ogg, Wave, Flac, Wma, MP4, Aiff
+
+
+class ContentSniffer:
+    """Determines the real type of a download from the magic bytes at its start.
+
+    Audio formats are recognized by TinyTag's own signature table, which is extended here
+    by images, video containers, documents and the markup servers tend to send instead of
+    the file that was linked.
+    """
+    # https://en.wikipedia.org/wiki/List_of_file_signatures
+    # Checked in order, so more specific signatures have to come first
+    _magic_bytes_mapping = [
+        (b'^\xff\xd8\xff', ('image/jpeg', '.jpg')),
+        (b'^\x89PNG\r\n\x1a\n', ('image/png', '.png')),
+        (b'^GIF8[79]a', ('image/gif', '.gif')),
+        (b'^RIFF....WEBP', ('image/webp', '.webp')),
+        (b'^(II\\*\x00|MM\x00\\*)', ('image/tiff', '.tiff')),
+        (b'^....ftyp(avif|avis)', ('image/avif', '.avif')),
+        (b'^....ftyp(heic|heix|mif1|msf1)', ('image/heic', '.heic')),
+        (b'^....ftypqt  ', ('video/quicktime', '.mov')),
+        (b'^....ftypM4V', ('video/x-m4v', '.m4v')),
+        (b'^....ftyp3g[p2]', ('video/3gpp', '.3gp')),
+        (b'^....ftypM4[AB]', ('audio/mp4', '.m4a')),
+        (b'^....ftyp', ('video/mp4', '.mp4')),
+        (b'^\x1a\x45\xdf\xa3.{0,64}webm', ('video/webm', '.webm')),
+        (b'^\x1a\x45\xdf\xa3', ('video/x-matroska', '.mkv')),
+        (b'^RIFF....AVI ', ('video/x-msvideo', '.avi')),
+        (b'^FLV\x01', ('video/x-flv', '.flv')),
+        (b'^\x00\x00\x01[\xb3\xba]', ('video/mpeg', '.mpg')),
+        (b'^%PDF-', ('application/pdf', '.pdf')),
+        (b'^PK\x03\x04', ('application/zip', '.zip')),
+        (b'^\x1f\x8b', ('application/gzip', '.gz')),
+        (b'^(\xef\xbb\xbf)?\\s*<(?i:!doctype html|html|head|body)', ('text/html', '.html')),
+        (b'^(\xef\xbb\xbf)?\\s*<\\?xml', ('application/xml', '.xml')),
+    ]
+    _compiled_mapping = [
+        (re.compile(magic, re.DOTALL), result) for magic, result in _magic_bytes_mapping
+    ]
+    _tinytag_mapping = {
+        ID3: ('audio/mpeg', '.mp3'),
+        Ogg: ('audio/ogg', '.ogg'),
+        Wave: ('audio/wav', '.wav'),
+        Flac: ('audio/flac', '.flac'),
+        Wma: ('audio/x-ms-wma', '.wma'),
+        MP4: ('audio/mp4', '.m4a'),
+        Aiff: ('audio/aiff', '.aif'),
+    }
+
+    @classmethod
+    def sniff(cls, header: bytes) -> tuple[str, str] | None:
+        """Returns the mimetype and extension matching the header, or None if it's unknown."""
+        header = bytes(header[:512])
+        for magic, result in cls._compiled_mapping:
+            if magic.match(header):
+                return result
+        parser = TinyTag._get_parser_for_file_handle(io.BufferedReader(io.BytesIO(header)))
+        return cls._tinytag_mapping.get(parser)
@@ -1,80 +1,124 @@
-from mautrix.types import RoomID
-from mautrix.util.async_db import Database
+import asyncio
+import logging
+import time
 
+from mautrix.types import EventID, RoomID
+from mautrix.util.async_db import Connection, Database
+
+from urldownload.AttachmentCache import AttachmentCache
 from urldownload.dataclass.Attachment import Attachment
 
 
 class DBManager:
     db: Database
+    log: logging.Logger
+    # Write-through cache of the status table, (enabled, debug) by room
+    room_status: dict[RoomID, tuple[bool, bool]]
+    # Attachments and usage counts are written behind in batches, reads see them right away
+    max_pending: int
+    pending_attachments: dict[str, Attachment]
+    pending_usage: dict[tuple[str, RoomID], tuple[int, int]]
+    # The attachment last downloaded from each URL, with the validators that URL sent
+    pending_urls: dict[str, Attachment]
+    _flushing_attachments: dict[str, Attachment]
+    _flushing_urls: dict[str, Attachment]
+    _flush_lock: asyncio.Lock
+    _flush_task: asyncio.Task | None
+    attachment_cache: AttachmentCache
 
-    def __init__(self, db: Database) -> None:
+    def __init__(self, db: Database, log: logging.Logger, max_pending: int = 100, cache_size: int = 1000) -> None:
         self.db = db
+        self.log = log
+        self.attachment_cache = AttachmentCache(cache_size)
+        self.room_status = {}
+        self.max_pending = max_pending
+        self.pending_attachments = {}
+        self.pending_usage = {}
+        self.pending_urls = {}
+        self._flushing_attachments = {}
+        self._flushing_urls = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+
+    async def load_room_status(self) -> None:
+        q = """
+        SELECT room_id, enabled, debug
+        FROM status
+        """
+        rows = await self.db.fetch(q)
+        loaded = {row["room_id"]: (bool(row["enabled"]), bool(row["debug"])) for row in rows}
+        # Changes made while loading are newer
+        self.room_status = {**loaded, **self.room_status}
+
+    async def get_room_status(self, room_id: RoomID) -> tuple[bool, bool]:
+        return self.room_status.get(room_id, (False, False))
 
     async def join_room(self, room_id: RoomID) -> None:
         q = """
         INSERT INTO status (room_id, enabled, debug)
         VALUES ($1, $2, $3)
+        ON CONFLICT (room_id) DO NOTHING
         """
         await self.db.execute(q, room_id, False, False)
+        self.room_status.setdefault(room_id, (False, False))
 
     async def is_in_room(self, room_id: RoomID) -> bool:
-        q = """
-        SELECT enabled
-        FROM status
-        WHERE room_id = $1
-        """
-        rows = await self.db.fetch(q, room_id)
-
-        return rows is not None and len(rows) > 0
+        return room_id in self.room_status
 
     async def ensure_in_room(self, room_id: RoomID) -> None:
         if not await self.is_in_room(room_id):
             await self.join_room(room_id)
 
     async def is_enabled_in_room(self, room_id: RoomID) -> bool:
-        q = """
-        SELECT enabled
-        FROM status
-        WHERE room_id = $1
-        """
-        rows = await self.db.fetch(q, room_id)
-
-        return rows[0]["enabled"] if rows is not None and len(rows) > 0 else False
+        enabled, _ = await self.get_room_status(room_id)
+        return enabled
 
     async def set_enabled_in_room(self, room_id: RoomID, enabled:bool=True) -> bool:
-        await self.ensure_in_room(room_id)
-
         q = """
-        UPDATE status
-        SET enabled = $1
-        WHERE room_id = $2
+        INSERT INTO status (room_id, enabled, debug)
+        VALUES ($1, $2, $3)
+        ON CONFLICT (room_id) DO UPDATE SET enabled = excluded.enabled
         """
-        await self.db.execute(q, enabled, room_id)
+        await self.db.execute(q, room_id, enabled, False)
+        self.room_status[room_id] = (enabled, self.room_status.get(room_id, (False, False))[1])
 
     async def is_debug_in_room(self, room_id: RoomID) -> bool:
+        _, debug = await self.get_room_status(room_id)
+        return debug
+
+    async def set_debug_in_room(self, room_id: RoomID, debug: bool = True) -> bool:
         q = """
-        SELECT debug
-        FROM status
-        WHERE room_id = $1
+        INSERT INTO status (room_id, enabled, debug)
+        VALUES ($1, $2, $3)
+        ON CONFLICT (room_id) DO UPDATE SET debug = excluded.debug
         """
-        rows = await self.db.fetch(q, room_id)
+        await self.db.execute(q, room_id, False, debug)
+        self.room_status[room_id] = (self.room_status.get(room_id, (False, False))[0], debug)
 
-        return rows[0]["debug"] if rows is not None and len(rows) > 0 else False
+    @staticmethod
+    def attachment_from_row(row) -> Attachment:
+        # Digests are stored as bytes, everywhere else they are hex
+        attachment = Attachment.from_row(row)
+        attachment.sha512sum = bytes(attachment.sha512sum).hex()
+        return attachment
 
-    async def set_debug_in_room(self, room_id: RoomID, debug: bool = True) -> bool:
-        await self.ensure_in_room(room_id)
+    def get_pending_attachment(self, sha512sum: str) -> Attachment | None:
+        return self.pending_attachments.get(sha512sum) or self._flushing_attachments.get(sha512sum)
 
-        q = """
-        UPDATE status
-        SET debug = $1
-        WHERE room_id = $2
-        """
-        await self.db.execute(q, debug, room_id)
+    def get_pending_attachment_by_url(self, url: str) -> Attachment | None:
+        return self.pending_urls.get(url) or self._flushing_urls.get(url)
 
     async def get_attachment(self, sha512sum: str) -> str:
+        cached = self.attachment_cache.get(sha512sum)
+        if cached is not None:
+            return cached
+        pending = self.get_pending_attachment(sha512sum)
+        if pending is not None:
+            return pending
+
         q = """
         SELECT
-            sha512sum,
+            digest AS sha512sum,
             uri,
             mimetype,
             size,
@@ -85,22 +129,134 @@ class DBManager:
             thumbnail_width,
             thumbnail_height,
             thumbnail_size,
-            url
+            url,
+            etag,
+            last_modified,
+            content_length
         FROM attachment
-        WHERE sha512sum = $1
+        WHERE digest = $1
+        """
+
+        rows = await self.db.fetch(q, bytes.fromhex(sha512sum))
+
+        if rows is None or len(rows) == 0:
+            return None
+        else:
+            attachment = self.attachment_from_row(rows[0])
+            self.attachment_cache.add(attachment)
+            return attachment
+
+    async def get_attachment_by_url(self, url: str) -> Attachment | None:
+        # The attachment last downloaded from the URL, with the validators to revalidate with
+        cached = self.attachment_cache.get_by_url(url)
+        if cached is not None:
+            return cached
+        pending = self.get_pending_attachment_by_url(url)
+        if pending is not None:
+            return pending
+
+        q = """
+        SELECT
+            a.digest AS sha512sum,
+            a.uri,
+            a.mimetype,
+            a.size,
+            a.thumbnail_uri,
+            a.width,
+            a.height,
+            a.duration,
+            a.thumbnail_width,
+            a.thumbnail_height,
+            a.thumbnail_size,
+            u.url,
+            u.etag,
+            u.last_modified,
+            a.content_length
+        FROM attachment_url u
+        JOIN attachment a ON a.digest = u.digest
+        WHERE u.url = $1
         """
 
-        rows = await self.db.fetch(q, sha512sum)
+        rows = await self.db.fetch(q, url)
 
         if rows is None or len(rows) == 0:
             return None
         else:
-            return Attachment.from_row(rows[0])
+            attachment = self.attachment_from_row(rows[0])
+            self.attachment_cache.add_for_url(attachment)
+            return attachment
+
+    async def store_attachment(self, attachment: Attachment) -> None:
+        # Moved to the end so it's the newest one for its URL
+        self.pending_attachments.pop(attachment.sha512sum, None)
+        self.pending_attachments[attachment.sha512sum] = attachment
+        self.attachment_cache.add(attachment)
+        self.flush_if_full()
+
+    async def store_url(self, attachment: Attachment) -> None:
+        # Only if the URL's validators or file changed since it was last stored
+        known = self.attachment_cache.get_by_url(attachment.url) or self.get_pending_attachment_by_url(attachment.url)
+        if known is not None and (known.sha512sum, known.etag, known.last_modified) == (
+                attachment.sha512sum, attachment.etag, attachment.last_modified):
+            return
+        self.pending_urls[attachment.url] = attachment
+        self.attachment_cache.add_for_url(attachment)
+        self.flush_if_full()
+
+    async def record_usage(self, sha512sum: str, room_id: RoomID) -> None:
+        key = (sha512sum, room_id)
+        hits, _ = self.pending_usage.get(key, (0, 0))
+        self.pending_usage[key] = (hits + 1, int(time.time() * 1000))
+        self.flush_if_full()
 
-    async def store_attachment(self, attachment: Attachment):
+    def flush_if_full(self) -> None:
+        # In the background, so writers never wait for the database or see its errors
+        if len(self.pending_attachments) + len(self.pending_usage) + len(self.pending_urls) < self.max_pending:
+            return
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self.flush())
+            self._flush_task.add_done_callback(self._log_flush_error)
+
+    def _log_flush_error(self, task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            self.log.error("Failed to write pending attachments", exc_info=task.exception())
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self.pending_attachments and not self.pending_usage and not self.pending_urls:
+                return
+            attachments, self.pending_attachments = self.pending_attachments, {}
+            usage, self.pending_usage = self.pending_usage, {}
+            urls, self.pending_urls = self.pending_urls, {}
+            # Still visible to reads until they're committed
+            self._flushing_attachments = attachments
+            self._flushing_urls = urls
+            committed = False
+            try:
+                async with self.db.acquire() as conn, conn.transaction():
+                    if attachments:
+                        await self._write_attachments(conn, list(attachments.values()))
+                    if usage:
+                        await self._write_usage(conn, usage)
+                    if urls:
+                        await self._write_urls(conn, list(urls.values()))
+                committed = True
+            finally:
+                if not committed:
+                    # Failed or cancelled, e.g. at shutdown, so it's retried with the next
+                    # flush. Writes made in the meantime are newer.
+                    self.pending_attachments = {**attachments, **self.pending_attachments}
+                    self.pending_urls = {**urls, **self.pending_urls}
+                    for key, (hits, last_used) in usage.items():
+                        pending_hits, pending_last_used = self.pending_usage.get(key, (0, 0))
+                        self.pending_usage[key] = (hits + pending_hits, max(last_used, pending_last_used))
+                self._flushing_attachments = {}
+                self._flushing_urls = {}
+
+    async def _write_attachments(self, conn: Connection, attachments: list[Attachment]) -> None:
         q = """
         INSERT INTO attachment (
-            sha512sum,
+            digest,
             uri,
             mimetype,
             size,
@@ -111,21 +267,194 @@ class DBManager:
             thumbnail_width,
             thumbnail_height,
             thumbnail_size,
-            url
-        ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12)
-        """
-
-        await self.db.execute(q,
-                              attachment.sha512sum,
-                              attachment.uri,
-                              attachment.mimetype,
-                              attachment.size,
-                              attachment.thumbnail_uri,
-                              attachment.width,
-                              attachment.height,
-                              attachment.duration,
-                              attachment.thumbnail_width,
-                              attachment.thumbnail_height,
-                              attachment.thumbnail_size,
-                              attachment.url
-                              )
\ No newline at end of file
+            url,
+            etag,
+            last_modified,
+            content_length
+        ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15)
+        ON CONFLICT (digest) DO UPDATE SET
+            uri = excluded.uri,
+            mimetype = excluded.mimetype,
+            size = excluded.size,
+            thumbnail_uri = excluded.thumbnail_uri,
+            width = excluded.width,
+            height = excluded.height,
+            duration = excluded.duration,
+            thumbnail_width = excluded.thumbnail_width,
+            thumbnail_height = excluded.thumbnail_height,
+            thumbnail_size = excluded.thumbnail_size,
+            url = excluded.url,
+            etag = excluded.etag,
+            last_modified = excluded.last_modified,
+            content_length = excluded.content_length
+        """
+
+        await conn.executemany(q, [
+            (
+                bytes.fromhex(attachment.sha512sum),
+                attachment.uri,
+                attachment.mimetype,
+                attachment.size,
+                attachment.thumbnail_uri,
+                attachment.width,
+                attachment.height,
+                attachment.duration,
+                attachment.thumbnail_width,
+                attachment.thumbnail_height,
+                attachment.thumbnail_size,
+                attachment.url,
+                attachment.etag,
+                attachment.last_modified,
+                attachment.content_length
+            )
+            for attachment in attachments
+        ])
+
+    async def _write_usage(self, conn: Connection, usage: dict[tuple[str, RoomID], tuple[int, int]]) -> None:
+        totals = {}
+        for (sha512sum, _), (hits, last_used) in usage.items():
+            total_hits, total_last_used = totals.get(sha512sum, (0, 0))
+            totals[sha512sum] = (total_hits + hits, max(last_used, total_last_used))
+
+        q = """
+        UPDATE attachment
+        SET hit_count = hit_count + $2, last_used = $3
+        WHERE digest = $1
+        """
+        await conn.executemany(q, [(bytes.fromhex(sha512sum), hits, last_used) for sha512sum, (hits, last_used) in totals.items()])
+
+        q = """
+        INSERT INTO attachment_room (digest, room_id, hit_count, last_used)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (digest, room_id) DO UPDATE
+        SET hit_count = attachment_room.hit_count + excluded.hit_count, last_used = excluded.last_used
+        """
+        await conn.executemany(q, [
+            (bytes.fromhex(sha512sum), room_id, hits, last_used) for (sha512sum, room_id), (hits, last_used) in usage.items()
+        ])
+
+    async def _write_urls(self, conn: Connection, attachments: list[Attachment]) -> None:
+        q = """
+        INSERT INTO attachment_url (url, digest, etag, last_modified, updated_at)
+        VALUES ($1, $2, $3, $4, $5)
+        ON CONFLICT (url) DO UPDATE SET
+            digest = excluded.digest,
+            etag = excluded.etag,
+            last_modified = excluded.last_modified,
+            updated_at = excluded.updated_at
+        """
+        now = int(time.time() * 1000)
+        await conn.executemany(q, [
+            (attachment.url, bytes.fromhex(attachment.sha512sum), attachment.etag, attachment.last_modified, now)
+            for attachment in attachments
+        ])
+
+    async def delete_attachment(self, sha512sum: str) -> None:
+        # Waits for a running flush, which could write the attachment again otherwise
+        async with self._flush_lock:
+            self.attachment_cache.remove(sha512sum)
+            self.pending_attachments.pop(sha512sum, None)
+            for key in [key for key in self.pending_usage if key[0] == sha512sum]:
+                del self.pending_usage[key]
+            for url in [url for url, attachment in self.pending_urls.items() if attachment.sha512sum == sha512sum]:
+                del self.pending_urls[url]
+            async with self.db.acquire() as conn, conn.transaction():
+                q = """
+                DELETE FROM attachment_url
+                WHERE digest = $1
+                """
+                await conn.execute(q, bytes.fromhex(sha512sum))
+
+                q = """
+                DELETE FROM attachment_room
+                WHERE digest = $1
+                """
+                await conn.execute(q, bytes.fromhex(sha512sum))
+
+                q = """
+                DELETE FROM attachment
+                WHERE digest = $1
+                """
+                await conn.execute(q, bytes.fromhex(sha512sum))
+
+    async def enqueue_jobs(self, room_id: RoomID, event_id: EventID, urls: list[str]) -> None:
+        q = """
+        INSERT INTO job (room_id, event_id, url, position, state, attempts, created_at, updated_at)
+        VALUES ($1, $2, $3, $4, 'pending', 0, $5, $5)
+        ON CONFLICT DO NOTHING
+        """
+        now = int(time.time() * 1000)
+        await self.db.executemany(q, [(room_id, event_id, url, position, now) for position, url in enumerate(urls)])
+
+    async def claim_job(self, room_id: RoomID, event_id: EventID, url: str) -> None:
+        q = """
+        UPDATE job
+        SET state = 'running', attempts = attempts + 1, updated_at = $1
+        WHERE room_id = $2 AND event_id = $3 AND url = $4
+        """
+        await self.db.execute(q, int(time.time() * 1000), room_id, event_id, url)
+
+    async def postpone_jobs(self, room_id: RoomID, event_id: EventID) -> None:
+        # Counted as an attempt, so jobs that can never be restored are given up on eventually
+        q = """
+        UPDATE job
+        SET state = 'pending', attempts = attempts + 1, updated_at = $1
+        WHERE room_id = $2 AND event_id = $3
+        """
+        await self.db.execute(q, int(time.time() * 1000), room_id, event_id)
+
+    async def complete_job(self, room_id: RoomID, event_id: EventID, url: str) -> None:
+        q = """
+        DELETE FROM job
+        WHERE room_id = $1 AND event_id = $2 AND url = $3
+        """
+        await self.db.execute(q, room_id, event_id, url)
+
+    async def get_unfinished_jobs(self, max_attempts: int) -> list:
+        # Jobs still marked as running were interrupted by a restart, those that were
+        # interrupted too often are given up on instead of being retried forever
+        q = """
+        DELETE FROM job
+        WHERE attempts >= $1
+        """
+        await self.db.execute(q, max_attempts)
+
+        q = """
+        UPDATE job
+        SET state = 'pending'
+        WHERE state = 'running'
+        """
+        await self.db.execute(q)
+
+        q = """
+        SELECT room_id, event_id, url
+        FROM job
+        ORDER BY created_at, room_id, event_id, position
+        """
+        return await self.db.fetch(q)
+
+    async def get_rejected_urls(self, fingerprint: str) -> list:
+        q = """
+        SELECT url, reason, expires_at
+        FROM rejected_url
+        WHERE fingerprint = $1 AND expires_at > $2
+        ORDER BY expires_at
+        """
+        return await self.db.fetch(q, fingerprint, int(time.time()))
+
+    async def store_rejected_url(self, url: str, reason: str, expires_at: float, fingerprint: str) -> None:
+        q = """
+        INSERT INTO rejected_url (url, reason, expires_at, fingerprint)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (url) DO UPDATE
+        SET reason = excluded.reason, expires_at = excluded.expires_at, fingerprint = excluded.fingerprint
+        """
+        await self.db.execute(q, url, reason, int(expires_at), fingerprint)
+
+    async def purge_rejected_urls(self, fingerprint: str) -> None:
+        # Drops expired rejections and those made under a different filter configuration
+        q = """
+        DELETE FROM rejected_url
+        WHERE expires_at <= $1 OR fingerprint != $2
+        """
+        await self.db.execute(q, int(time.time()), fingerprint)
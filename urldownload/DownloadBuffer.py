@@ -0,0 +1,273 @@
+import asyncio
+import io
+import os
+import tempfile
+from hashlib import sha512
+from typing import AsyncIterator, BinaryIO
+
+from urldownload.MemoryBudget import MemoryBudget
+
+
+class DownloadBuffer:
+    """Accumulates a streamed response body.
+
+    Chunks are appended to a single bytearray, which grows in amortized linear time
+    instead of copying the whole body on every chunk like ``bytes += chunk`` does.
+    Bodies larger than ``spool_threshold`` are written to a temporary file instead,
+    so a few large concurrent downloads don't have to fit into memory.
+
+    Bytes held in memory are accounted against a shared ``MemoryBudget``. When it is
+    exhausted the body is spooled to disk as well, or, if spooling is disabled, writing
+    waits up to ``wait_timeout`` seconds until other downloads have released enough memory.
+
+    The SHA-512 digest is updated as chunks arrive, large chunks are hashed in a thread
+    since hashlib releases the GIL, so the digest is ready when the last byte is.
+
+    A body of known size can also be preallocated and written in parts that arrive
+    concurrently, the digest then follows the contiguous prefix written so far.
+    """
+    # Chunks at least this large are hashed and written off the event loop
+    OFFLOAD_SIZE = 128 * 1024
+
+    spool_threshold: int
+    spool_dir: str | None
+    size: int
+    _data: bytearray
+    _file: BinaryIO | None
+    _view: memoryview | None
+    _budget: MemoryBudget | None
+    _reserved: int
+    wait_timeout: float | None
+    _parts: list[list[int]] | None
+    _hashed: int
+    _hashing: bool
+
+    def __init__(self, spool_threshold: int = 0, spool_dir: str | None = None, expected_size: int = 0,
+                 budget: MemoryBudget | None = None, wait_timeout: float | None = None) -> None:
+        self.spool_threshold = spool_threshold
+        self.spool_dir = spool_dir or None
+        self.size = 0
+        self._data = bytearray()
+        self._file = None
+        self._view = None
+        self._budget = budget
+        self._reserved = 0
+        self.wait_timeout = wait_timeout
+        self._hash = sha512()
+        self._parts = None
+        self._hashed = 0
+        self._hashing = False
+        if self.should_spool(expected_size):
+            self._rollover()
+
+    @property
+    def spooled(self) -> bool:
+        return self._file is not None
+
+    def should_spool(self, size: int) -> bool:
+        return 0 < self.spool_threshold < size
+
+    def _rollover(self) -> None:
+        self._file = tempfile.NamedTemporaryFile(prefix="urldownload-", dir=self.spool_dir)
+        self._file.write(self._data)
+        self._data = bytearray()
+        self._release()
+
+    def _release(self) -> None:
+        if self._budget is not None and self._reserved:
+            self._budget.release(self._reserved)
+        self._reserved = 0
+
+    async def reserve(self, size: int, timeout: float) -> None:
+        # Waits for memory for a body of known size up front, it's spooled if none frees up
+        if self._budget is None or self._file is not None:
+            return
+        if await self._budget.acquire(size, timeout):
+            self._reserved += size
+        elif self.spool_threshold > 0:
+            self._rollover()
+
+    async def _reserve_for(self, size: int) -> None:
+        missing = size - self._reserved
+        if self._budget is None or missing <= 0:
+            return
+        if self._budget.try_acquire(missing):
+            self._reserved += missing
+        elif self.spool_threshold > 0:
+            self._rollover()
+        # What's reserved already counts against the budget too, a body that can't fit as a
+        # whole would otherwise wait for memory it holds itself
+        elif self._budget.fits(size) and await self._budget.acquire(missing, self.wait_timeout):
+            self._reserved += missing
+        else:
+            raise MemoryError(f"Body of {size} bytes exceeds the memory budget")
+
+    @property
+    def sha512sum(self) -> str:
+        return self._hash.hexdigest()
+
+    def _append(self, chunk: bytes) -> None:
+        self._hash.update(chunk)
+        if self._file is not None:
+            self._file.write(chunk)
+        else:
+            self._data += chunk
+
+    async def write(self, chunk: bytes) -> None:
+        if self._file is None and self.should_spool(self.size + len(chunk)):
+            self._rollover()
+        if self._file is None:
+            await self._reserve_for(self.size + len(chunk))
+        if len(chunk) >= self.OFFLOAD_SIZE:
+            await asyncio.to_thread(self._append, chunk)
+        else:
+            self._append(chunk)
+        self.size += len(chunk)
+
+    async def preallocate(self, boundaries: list[int]) -> None:
+        # Switches to writing in parts, given by the offsets they start at followed by the total size
+        size = boundaries[-1]
+        if self._file is None and self.should_spool(size):
+            self._rollover()
+        if self._file is not None:
+            self._file.flush()
+            self._file.truncate(size)
+        else:
+            await self._reserve_for(size)
+            self._data = bytearray(size)
+        # Next offset to write and end of each part
+        self._parts = [[start, end] for start, end in zip(boundaries, boundaries[1:])]
+
+    def remaining(self, index: int) -> int:
+        offset, end = self._parts[index]
+        return end - offset
+
+    def _write_at(self, offset: int, chunk: bytes) -> None:
+        if self._file is not None:
+            os.pwrite(self._file.fileno(), chunk, offset)
+        else:
+            self._data[offset:offset + len(chunk)] = chunk
+
+    async def write_part(self, index: int, chunk: bytes) -> None:
+        offset, end = self._parts[index]
+        if offset + len(chunk) > end:
+            raise ValueError(f"Part {index} is longer than {end - offset} more bytes")
+        if len(chunk) >= self.OFFLOAD_SIZE:
+            await asyncio.to_thread(self._write_at, offset, chunk)
+        else:
+            self._write_at(offset, chunk)
+        self._parts[index][0] += len(chunk)
+        self.size += len(chunk)
+        await self._advance_hash()
+
+    def _hashable_end(self) -> int:
+        # Everything up to the first part that isn't complete yet
+        for offset, end in self._parts:
+            if offset < end:
+                return offset
+        return self._parts[-1][1]
+
+    def _hash_range(self, start: int, end: int) -> None:
+        if self._file is not None:
+            fd = self._file.fileno()
+            while start < end:
+                data = os.pread(fd, min(end - start, 1024 * 1024), start)
+                self._hash.update(data)
+                start += len(data)
+        else:
+            with memoryview(self._data) as view:
+                self._hash.update(view[start:end])
+
+    async def _advance_hash(self) -> None:
+        # Only one pass at a time, it picks up parts written by others while it's hashing
+        if self._hashing:
+            return
+        self._hashing = True
+        try:
+            while (end := self._hashable_end()) > self._hashed:
+                if end - self._hashed >= self.OFFLOAD_SIZE:
+                    await asyncio.to_thread(self._hash_range, self._hashed, end)
+                else:
+                    self._hash_range(self._hashed, end)
+                self._hashed = end
+        finally:
+            self._hashing = False
+
+    async def finish_parts(self) -> None:
+        # Catches up with the parts written last, once all writers are done
+        if any(offset < end for offset, end in self._parts):
+            raise ValueError("Not all parts have been written")
+        await self._advance_hash()
+
+    def reset(self) -> None:
+        # Discards what was written so far to start over, the reserved memory is kept
+        if self._file is not None:
+            self._file.seek(0)
+            self._file.truncate()
+        else:
+            self._data = bytearray()
+        self.size = 0
+        self._hash = sha512()
+
+    def getbuffer(self) -> memoryview:
+        # Zero-copy view of a body held in memory, spooled bodies are read with iter_chunks.
+        # The buffer can't be written to anymore once it's exported.
+        if self._file is not None:
+            raise ValueError("The body was spooled to disk")
+        if self._view is None:
+            self._view = memoryview(self._data)
+        return self._view
+
+    def open(self) -> BinaryIO:
+        # Separate, seekable read handle, e.g. for parsing metadata. Bodies in memory are
+        # read in place, BytesIO would copy them outside of the memory budget.
+        if self._file is not None:
+            self._file.flush()
+            return open(self._file.name, "rb")
+        return io.BufferedReader(MemoryReader(self.getbuffer()))
+
+    async def iter_chunks(self, chunk_size: int = 1024 * 1024) -> AsyncIterator[bytes]:
+        # Reads a spooled body piecewise off the event loop instead of mapping it all at once
+        with self.open() as f:
+            while chunk := await asyncio.to_thread(f.read, chunk_size):
+                yield chunk
+
+    def close(self) -> None:
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._file is not None:
+            self._file.close()  # also deletes the temporary file
+            self._file = None
+        self._data = bytearray()
+        self._release()
+
+
+class MemoryReader(io.RawIOBase):
+    """Seekable, read-only file over a memoryview that doesn't copy it."""
+    _view: memoryview
+    _position: int
+
+    def __init__(self, view: memoryview) -> None:
+        self._view = view
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = max(0, min(len(b), len(self._view) - self._position))
+        b[:n] = self._view[self._position:self._position + n]
+        self._position += n
+        return n
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._view)}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
@@ -0,0 +1,128 @@
+import asyncio
+import time
+from email.utils import parsedate_to_datetime
+from typing import Mapping
+
+
+class RateLimited(Exception):
+    """Raised instead of waiting when a host asks to be retried later.
+
+    ``attempt`` is the number of the attempt the request has to be retried as.
+    """
+    host: str
+    attempt: int
+
+    def __init__(self, host: str, attempt: int) -> None:
+        super().__init__(f"Rate limited by {host}")
+        self.host = host
+        self.attempt = attempt
+
+
+class TokenBucket:
+    tokens: float
+    updated: float
+    blocked_until: float
+
+    def __init__(self, capacity: float) -> None:
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+
+class HostRateLimiter:
+    """Per-host token bucket limiting how fast requests are sent to each origin.
+
+    Besides the configured rate, a host can be blocked for a while, which is learned
+    from ``Retry-After`` on 429 responses and from ``RateLimit-*`` headers announcing
+    that the quota is used up.
+    """
+    # Buckets of idle hosts are dropped once there are this many
+    MAX_BUCKETS = 1024
+
+    rate: float
+    burst: float
+    buckets: dict[str, TokenBucket]
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.buckets = {}
+
+    def _get_bucket(self, host: str) -> TokenBucket:
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            if len(self.buckets) >= self.MAX_BUCKETS:
+                self._prune()
+            bucket = self.buckets[host] = TokenBucket(self.burst)
+        return bucket
+
+    def _prune(self) -> None:
+        now = time.monotonic()
+        for host, bucket in list(self.buckets.items()):
+            idle = bucket.tokens + (now - bucket.updated) * self.rate >= self.burst
+            if idle and bucket.blocked_until <= now:
+                del self.buckets[host]
+
+    def get_delay(self, host: str) -> float:
+        # Seconds until a request to the host may be sent, the token is taken if it's 0
+        bucket = self._get_bucket(host)
+        now = time.monotonic()
+        if bucket.blocked_until > now:
+            return bucket.blocked_until - now
+        if self.rate > 0:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+            if bucket.tokens < 1:
+                return (1 - bucket.tokens) / self.rate
+            bucket.tokens -= 1
+        return 0
+
+    async def acquire(self, host: str) -> None:
+        while (delay := self.get_delay(host)) > 0:
+            await asyncio.sleep(delay)
+
+    async def wait_unblocked(self, host: str) -> None:
+        # Waits out a block without taking a token, the request that follows takes it
+        bucket = self.buckets.get(host)
+        while bucket is not None and (delay := bucket.blocked_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    def block(self, host: str, delay: float) -> None:
+        bucket = self._get_bucket(host)
+        bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + delay)
+
+    def update(self, host: str, headers: Mapping[str, str]) -> float | None:
+        """Learns from the rate limit headers of a response.
+
+        Returns the delay the server asked for, if any.
+        """
+        delay = self.parse_retry_after(headers.get("Retry-After"))
+        if delay is None:
+            remaining = headers.get("RateLimit-Remaining", headers.get("X-RateLimit-Remaining"))
+            reset = headers.get("RateLimit-Reset", headers.get("X-RateLimit-Reset"))
+            if remaining is not None and reset is not None:
+                try:
+                    if int(remaining) <= 0:
+                        delay = float(reset)
+                        # Some servers send the reset as a timestamp instead of a delay
+                        if delay > 1e9:
+                            delay -= time.time()
+                except ValueError:
+                    pass
+        if delay is not None and delay > 0:
+            self.block(host, delay)
+            return delay
+        return None
+
+    @staticmethod
+    def parse_retry_after(value: str | None) -> float | None:
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        try:
+            return parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
@@ -0,0 +1,60 @@
+import asyncio
+from logging import Logger
+from typing import Awaitable, Callable
+
+from urldownload.dataclass.Job import Job
+
+
+class JobQueue:
+    """Bounded queue of download jobs worked off by a fixed pool of workers."""
+    queue: asyncio.Queue
+    workers: list[asyncio.Task]
+    handler: Callable[[Job], Awaitable[None]]
+    log: Logger
+    closed: bool
+
+    def __init__(self, handler: Callable[[Job], Awaitable[None]], worker_count: int, max_size: int, log: Logger) -> None:
+        self.queue = asyncio.Queue(maxsize=max_size)
+        self.handler = handler
+        self.log = log
+        self.closed = False
+        self.workers = [asyncio.create_task(self._work()) for _ in range(worker_count)]
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    @property
+    def max_size(self) -> int:
+        return self.queue.maxsize
+
+    def submit(self, job: Job) -> bool:
+        # Returns False instead of waiting when the queue is full, so callers can shed load
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def _work(self) -> None:
+        while True:
+            job = await self.queue.get()
+            try:
+                await self.handler(job)
+            except Exception:
+                self.log.exception("Unhandled error while processing a job")
+            finally:
+                self.queue.task_done()
+
+    async def stop(self, timeout: float) -> None:
+        # Stop accepting jobs, give the queued ones some time to finish, then cancel the rest
+        self.closed = True
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            self.log.warning(f"{self.depth} queued jobs were not finished before shutdown")
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
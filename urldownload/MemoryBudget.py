@@ -0,0 +1,54 @@
+import asyncio
+
+
+class MemoryBudget:
+    """Byte-weighted semaphore bounding the memory held by all download buffers together.
+
+    A capacity of 0 means unlimited.
+    """
+    capacity: int
+    used: int
+    _waiters: list[asyncio.Future]
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.used = 0
+        self._waiters = []
+
+    def fits(self, size: int) -> bool:
+        return self.capacity <= 0 or size <= self.capacity
+
+    def try_acquire(self, size: int) -> bool:
+        if self.capacity > 0 and self.used + size > self.capacity:
+            return False
+        self.used += size
+        return True
+
+    async def acquire(self, size: int, timeout: float | None = None) -> bool:
+        # Waits until enough has been released, returns False if that didn't happen in time
+        # or if the size could never fit
+        if not self.fits(size):
+            return False
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+        while not self.try_acquire(size):
+            remaining = deadline - loop.time() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                return False
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, remaining)
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        return True
+
+    def release(self, size: int) -> None:
+        self.used = max(0, self.used - size)
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
@@ -0,0 +1,37 @@
+import time
+from collections import OrderedDict
+
+
+class NegativeCache:
+    """Bounded in-memory cache of rejected URLs with a per-entry expiry.
+
+    The least recently rejected entries are evicted first once ``max_size`` is reached.
+    """
+    max_size: int
+    entries: OrderedDict[str, tuple[str, float]]
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, url: str) -> str | None:
+        entry = self.entries.get(url)
+        if entry is None:
+            return None
+        reason, expires_at = entry
+        if expires_at <= time.time():
+            del self.entries[url]
+            return None
+        return reason
+
+    def add(self, url: str, reason: str, expires_at: float) -> None:
+        self.entries[url] = (reason, expires_at)
+        self.entries.move_to_end(url)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self.entries.clear()
@@ -0,0 +1,21 @@
+from maubot import MessageEvent
+
+
+class NoticeRecorder:
+    """Stands in for the message event while a URL is processed on behalf of several messages.
+
+    Notices are recorded instead of sent, every message then replays them to its own room,
+    debug notices only if debugging is enabled there.
+    """
+    notices: list[str]
+
+    def __init__(self) -> None:
+        self.notices = []
+
+    async def respond(self, content: str) -> None:
+        self.notices.append(content)
+
+    async def replay(self, evt: MessageEvent, debug: bool) -> None:
+        for notice in self.notices:
+            if debug or not notice.startswith("[DEBUG]"):
+                await evt.respond(notice)
@@ -0,0 +1,43 @@
+import asyncio
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class Flight:
+    task: asyncio.Task
+    waiters: int
+
+    def __init__(self, task: asyncio.Task) -> None:
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into a single execution.
+
+    Callers arriving while a call for their key is in progress wait for its result
+    instead of starting their own. The call is only cancelled once nobody waits for it.
+    """
+    flights: dict[Hashable, Flight]
+
+    def __init__(self) -> None:
+        self.flights = {}
+
+    async def run(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = self.flights[key] = Flight(asyncio.ensure_future(func()))
+            flight.task.add_done_callback(lambda _: self._finish(key, flight))
+        flight.waiters += 1
+        try:
+            # Shielded so one waiter being cancelled doesn't cancel the call for the others
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+
+    def _finish(self, key: Hashable, flight: Flight) -> None:
+        if self.flights.get(key) is flight:
+            del self.flights[key]
@@ -0,0 +1,50 @@
+import asyncio
+from typing import AsyncIterator
+
+from maubot import Client
+from mautrix.types import ContentURI
+
+
+class StreamingUpload:
+    """Uploads a body to the media repository while it is still being downloaded.
+
+    Chunks are handed over through a small bounded queue, so the download is slowed down
+    to the upload speed instead of piling up the whole body in memory.
+    """
+    queue: asyncio.Queue
+    task: asyncio.Task
+    uri: ContentURI | None
+
+    def __init__(self, client: Client, size: int, mime_type: str, filename: str, max_chunks: int = 8) -> None:
+        self.queue = asyncio.Queue(maxsize=max_chunks)
+        self.uri = None
+        self.task = asyncio.create_task(client.upload_media(
+            data=self._iter_chunks(),
+            mime_type=mime_type,
+            filename=filename,
+            size=size
+        ))
+        self.task.add_done_callback(self._drain)
+
+    async def _iter_chunks(self) -> AsyncIterator[bytes]:
+        while (chunk := await self.queue.get()) is not None:
+            yield chunk
+
+    def _drain(self, _: asyncio.Task) -> None:
+        # Unblock a writer waiting for space if the upload stopped consuming chunks
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+    async def write(self, chunk: bytes) -> None:
+        await self.queue.put(chunk)
+        if self.task.done():
+            self.task.result()  # raises the upload error
+            raise RuntimeError("Upload finished before the download did")
+
+    async def finish(self) -> ContentURI:
+        await self.queue.put(None)
+        self.uri = await self.task
+        return self.uri
+
+    def cancel(self) -> None:
+        self.task.cancel()
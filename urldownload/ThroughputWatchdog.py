@@ -0,0 +1,88 @@
+import time
+from collections import OrderedDict, deque
+
+
+class DownloadStalled(Exception):
+    """Raised with the reason a download was given up on by its watchdog."""
+
+
+class ThroughputWatchdog:
+    """Detects downloads that are too slow to be worth waiting for.
+
+    The throughput is measured over a sliding window of ``stall_time`` seconds. A download
+    is given up on when it stays below ``min_rate`` bytes per second for that long, or
+    when at its current speed it wouldn't finish within ``deadline`` seconds.
+    """
+    min_rate: float
+    stall_time: float
+    deadline: float
+    expected_size: int
+    started_at: float
+    samples: deque[tuple[float, int]]
+
+    def __init__(self, min_rate: float, stall_time: float, deadline: float, expected_size: int = 0) -> None:
+        self.min_rate = min_rate
+        self.stall_time = stall_time
+        self.deadline = deadline
+        self.expected_size = expected_size
+        self.started_at = time.monotonic()
+        self.samples = deque([(self.started_at, 0)])
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    @property
+    def average_rate(self) -> float:
+        received = self.samples[-1][1]
+        return received / max(self.elapsed, 1e-3)
+
+    def update(self, received: int) -> str | None:
+        """Records the total number of bytes received so far.
+
+        Returns why the download should be aborted, or None if it's doing fine.
+        """
+        now = time.monotonic()
+        self.samples.append((now, received))
+        # Keep one sample at or before the start of the window to measure across all of it
+        while len(self.samples) > 2 and now - self.samples[1][0] >= self.stall_time:
+            self.samples.popleft()
+
+        elapsed = now - self.started_at
+        if elapsed > self.deadline:
+            return f"exceeded the deadline of {self.deadline:.0f} seconds"
+        if elapsed < self.stall_time:
+            return None
+
+        window_start, window_received = self.samples[0]
+        rate = (received - window_received) / max(now - window_start, 1e-3)
+        if rate < self.min_rate:
+            return f"throughput of {rate:.0f} B/s stayed below {self.min_rate:.0f} B/s for {self.stall_time:.0f} seconds"
+        if self.expected_size > received and rate > 0:
+            projected = elapsed + (self.expected_size - received) / rate
+            if projected > self.deadline:
+                return f"would take {projected:.0f} seconds, more than the deadline of {self.deadline:.0f} seconds"
+        return None
+
+
+class HostThroughput:
+    """Moving average of the throughput observed per host, bounded to the most recent hosts."""
+    # Weight of the newest observation in the moving average
+    SMOOTHING = 0.3
+
+    max_hosts: int
+    rates: OrderedDict[str, float]
+
+    def __init__(self, max_hosts: int = 1024) -> None:
+        self.max_hosts = max_hosts
+        self.rates = OrderedDict()
+
+    def get(self, host: str) -> float | None:
+        return self.rates.get(host)
+
+    def record(self, host: str, rate: float) -> None:
+        previous = self.rates.get(host)
+        self.rates[host] = rate if previous is None else previous + self.SMOOTHING * (rate - previous)
+        self.rates.move_to_end(host)
+        while len(self.rates) > self.max_hosts:
+            self.rates.popitem(last=False)
@@ -2,37 +2,55 @@ from maubot import Plugin, MessageEvent
 from maubot.handlers import command, event
 from mautrix.types import EventType, MessageType, VideoInfo, AudioInfo, ImageInfo, FileInfo, RelatesTo, RelationType, InReplyTo, EventID, MediaRepoConfig
 import re
-from urllib.parse import urlparse, unquote_plus
+from urllib.parse import urlparse, urlsplit, urlunsplit, unquote_plus
 from os.path import basename, splitext
 from mimetypes import guess_type
 import aiohttp
 import asyncio
 import struct
 import io
+import time
+from hashlib import sha1
 from tinytag import TinyTag
+from attr import evolve
 
-from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
+from mautrix.util.config import BaseProxyConfig
 
 from urldownload.DBManager import DBManager
 from mautrix.util.async_db import UpgradeTable
 
+from .CircuitBreaker import CircuitBreaker, CircuitOpen
 from .Config import Config
+from .ContentSniffer import ContentSniffer
+from .DownloadBuffer import DownloadBuffer
+from .HostRateLimiter import HostRateLimiter, RateLimited
+from .JobQueue import JobQueue
+from .MemoryBudget import MemoryBudget
+from .NegativeCache import NegativeCache
+from .NoticeRecorder import NoticeRecorder
+from .SingleFlight import SingleFlight
+from .StreamingUpload import StreamingUpload
+from .ThroughputWatchdog import DownloadStalled, HostThroughput, ThroughputWatchdog
 from .dataclass.Attachment import Attachment
+from .dataclass.Job import Job
 from .migrations import upgrade_table
 
-from hashlib import sha512
 
-class Config(BaseProxyConfig):
-    def do_update(self, helper: ConfigUpdateHelper) -> None:
-        helper.copy("command_prefix")
-        helper.copy("whitelist")
-        helper.copy("url_regex")
-        helper.copy("mimetype_regex")
-        helper.copy("extension_regex")
-    
 class URLDownloadBot(Plugin):
     dbm: DBManager
     config: Config
+    session: aiohttp.ClientSession
+    download_semaphore: asyncio.Semaphore
+    job_queue: JobQueue
+    url_flights: SingleFlight
+    hash_flights: SingleFlight
+    negative_cache: NegativeCache
+    filter_fingerprint: str
+    upload_size: int
+    rate_limiter: HostRateLimiter
+    circuit_breaker: CircuitBreaker
+    memory_budget: MemoryBudget
+    host_throughput: HostThroughput
 
     @classmethod
     def get_config_class(cls) -> type[BaseProxyConfig]:
@@ -60,10 +78,78 @@ class URLDownloadBot(Plugin):
     def get_extension_regex(self) -> str:
         return self.config["extension_regex"]
 
+    def get_download_chunk_size(self) -> int:
+        return self.config["download_chunk_size"]
+
+    def get_filter_fingerprint(self) -> str:
+        filters = (self.get_url_regex(), self.get_mimetype_regex(), self.get_extension_regex())
+        return sha1("\n".join(filters).encode("utf-8")).hexdigest()
+
+    def normalize_url(self, url: str) -> str:
+        parts = urlsplit(url)
+        return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or "/", parts.query, ""))
+
+    def create_session(self) -> aiohttp.ClientSession:
+        # One pooled session for the plugin's lifetime so connections, TLS sessions and
+        # DNS results are reused across URLs, most links point to the same few CDNs
+        connector = aiohttp.TCPConnector(
+            limit=self.config["http.limit"],
+            limit_per_host=self.config["http.limit_per_host"],
+            ttl_dns_cache=self.config["http.dns_cache_ttl"],
+            keepalive_timeout=self.config["http.keepalive_timeout"]
+        )
+        return aiohttp.ClientSession(connector=connector)
+
     async def start(self) -> None:
         await super().start()
         self.config.load_and_update()
-        self.dbm = DBManager(self.database)
+        # Event handlers are registered already, so everything they use has to exist before
+        # the first await, the state is loaded from the database and homeserver afterwards
+        self.dbm = DBManager(self.database, self.log, self.config["write_behind.max_pending"], self.config["attachment_cache.max_size"])
+        self.session = self.create_session()
+        self.rate_limiter = HostRateLimiter(self.config["rate_limit.requests_per_second"], self.config["rate_limit.burst"])
+        self.circuit_breaker = CircuitBreaker(self.config["circuit_breaker.failure_threshold"], self.config["circuit_breaker.reset_timeout"])
+        self.upload_size = 1024 * 1024 * 50
+        self.download_semaphore = asyncio.Semaphore(self.config["concurrency.total"])
+        self.memory_budget = MemoryBudget(self.config["memory_budget.max_bytes"])
+        self.host_throughput = HostThroughput()
+        self.url_flights = SingleFlight()
+        self.hash_flights = SingleFlight()
+        self.negative_cache = NegativeCache(self.config["negative_cache.max_size"])
+        self.filter_fingerprint = self.get_filter_fingerprint()
+        self.job_queue = JobQueue(self.process_job, self.config["queue.workers"], self.config["queue.max_size"], self.log)
+        self.sched.run_periodically(self.config["write_behind.flush_interval"], self.dbm.flush)
+        self.sched.run_periodically(self.config["media_repo_refresh_interval"], self.refresh_upload_size)
+
+        await self.dbm.load_room_status()
+        await self.refresh_upload_size()
+        if self.config["negative_cache.persist"]:
+            await self.dbm.purge_rejected_urls(self.filter_fingerprint)
+            for row in await self.dbm.get_rejected_urls(self.filter_fingerprint):
+                self.negative_cache.add(row["url"], row["reason"], row["expires_at"])
+        try:
+            await self.resume_jobs()
+        except Exception:
+            self.log.exception("Failed to resume unfinished jobs")
+
+    async def on_external_config_update(self) -> None:
+        super().on_external_config_update()
+        # Rejections were made under the old filters, they may not hold anymore
+        fingerprint = self.get_filter_fingerprint()
+        if fingerprint != self.filter_fingerprint:
+            self.filter_fingerprint = fingerprint
+            self.negative_cache.clear()
+            if self.config["negative_cache.persist"]:
+                await self.dbm.purge_rejected_urls(fingerprint)
+
+    async def stop(self) -> None:
+        await self.job_queue.stop(self.config["queue.drain_timeout"])
+        try:
+            await self.dbm.flush()
+        except Exception:
+            self.log.exception("Failed to write pending attachments")
+        await self.session.close()
+        await super().stop()
 
     @command.new(name=get_command_name, require_subcommand=True)
     async def base_command(self, evt: MessageEvent) -> None:
@@ -81,9 +167,9 @@ class URLDownloadBot(Plugin):
 
     @base_command.subcommand(help="Get status of URLDownloader in this chat")
     async def status(self, evt: MessageEvent) -> None:
-        enabled = await self.dbm.is_enabled_in_room(evt.room_id)
-        debug = await self.dbm.is_debug_in_room(evt.room_id)
-        await self.client.send_notice(evt.room_id, f"Enabled: {enabled} Debug: {debug}")
+        enabled, debug = await self.dbm.get_room_status(evt.room_id)
+        tripped = ", ".join(f"{host} ({state})" for host, state in self.circuit_breaker.get_tripped_hosts().items())
+        await self.client.send_notice(evt.room_id, f"Enabled: {enabled} Debug: {debug} Queue: {self.job_queue.depth}/{self.job_queue.max_size} Memory: {self.memory_budget.used}/{self.memory_budget.capacity} bytes Attachment cache: {self.dbm.attachment_cache.hits} hits, {self.dbm.attachment_cache.misses} misses Tripped hosts: {tripped or 'none'}")
 
     @base_command.subcommand(help="Manage or get debug status in this room")
     @command.argument("state", "State of debug mode", required=False)
@@ -96,80 +182,442 @@ class URLDownloadBot(Plugin):
             await self.dbm.set_debug_in_room(evt.room_id, state)
             await self.client.send_notice(evt.room_id, f"Debug: {state}")
 
-    async def get_file_info(self, session, url, evt, debug):
+    async def get_file_info(self, response, url, evt, debug):
         try:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=60), allow_redirects=True) as response:
-                if response.status == 429:  # Too Many Requests
-                    await evt.respond(f"Rate limit exceeded for URL {url}. Skipping.")
-                    return None
-
-                headers = response.headers
-                content_type = headers.get("Content-Type")
-                content_length = headers.get("Content-Length")
-                content_disposition = headers.get("Content-Disposition")
+            headers = response.headers
+            content_type = headers.get("Content-Type")
+            content_length = headers.get("Content-Length")
+            content_disposition = headers.get("Content-Disposition")
+
+            filename = None
+            if content_disposition:
+                match = re.search(r'filename\*?="?([^"]+)"?', content_disposition)
+                if match:
+                    filename = unquote_plus(match.group(1))
+
+            if not filename:
+                filename = unquote_plus(basename(urlparse(url).path))
+
+            extension = splitext(filename)[1]
+            mimetype = content_type
+            if mimetype is None or mimetype == 'application/octet-stream':
+                mimetype = guess_type(filename)[0]
+                
+            # 0 means the server didn't tell us, the size limit is then enforced while streaming
+            file_size = int(content_length) if content_length else 0
 
-                filename = None
-                if content_disposition:
-                    match = re.search(r'filename\*?="?([^"]+)"?', content_disposition)
-                    if match:
-                        filename = unquote_plus(match.group(1))
+            if debug:
+                await evt.respond(f"[DEBUG] Filename: {filename}, Determined MIME type: {mimetype} and File_Size: {file_size}")
+
+            return {
+                "filename": filename,
+                "mimetype": mimetype,
+                "declared_mimetype": content_type,
+                "extension": extension,
+                "size": file_size,
+                "etag": headers.get("ETag"),
+                "last_modified": headers.get("Last-Modified")
+            }
+        except Exception as e:
+            if debug:
+                await evt.respond(f"[DEBUG] Error in get_file_info: {str(e)}")
+            return None
 
-                if not filename:
-                    filename = unquote_plus(basename(urlparse(url).path))
+    def get_rejection(self, url: str) -> str | None:
+        return self.negative_cache.get(self.normalize_url(url))
+
+    async def reject(self, url: str, reason: str) -> None:
+        # Remember why a URL was rejected so reposts are skipped without any network I/O
+        ttl = self.config[f"negative_cache.ttl.{reason}"]
+        if ttl <= 0:
+            return
+        key = self.normalize_url(url)
+        expires_at = time.time() + ttl
+        self.negative_cache.add(key, reason, expires_at)
+        if self.config["negative_cache.persist"]:
+            await self.dbm.store_rejected_url(key, reason, expires_at, self.filter_fingerprint)
+
+    async def request(self, url, headers, evt, debug, first_attempt=0, requeue=False):
+        # All requests to an origin share its rate limit. A 429 blocks the host for as long
+        # as it asks for, after which the request is retried instead of being dropped.
+        # With requeue, RateLimited is raised instead of waiting here, so the caller can
+        # give up its download slot in the meantime.
+        # Origins that keep failing are skipped right away while their circuit is open
+        host = urlsplit(url).hostname or ""
+        if not self.circuit_breaker.allow(host):
+            return None
+        retries = self.config["rate_limit.max_retries"]
+        for attempt in range(first_attempt, retries + 1):
+            await self.rate_limiter.acquire(host)
+            # There's no total timeout, slow downloads are stopped by the throughput watchdog.
+            # Connection errors are counted as failures by whoever gives up on the download.
+            timeout = aiohttp.ClientTimeout(total=None, connect=60, sock_read=self.config["watchdog.stall_time"])
+            response = await self.session.get(url, headers=headers, timeout=timeout, allow_redirects=True)
+            if response.status >= 500:
+                self.circuit_breaker.record_failure(host)
+            else:
+                self.circuit_breaker.record_success(host)
+            delay = self.rate_limiter.update(host, response.headers)
+            if response.status != 429 or attempt == retries:
+                return response
+
+            if delay is None:
+                delay = self.config["rate_limit.default_delay"] * 2 ** attempt
+                self.rate_limiter.block(host, delay)
+            response.release()
+            if delay > self.config["rate_limit.max_delay"]:
+                return response
+            if debug:
+                await evt.respond(f"[DEBUG] Rate limited by {host}, retrying in {delay:.0f} seconds")
+            if requeue:
+                raise RateLimited(host, attempt + 1)
+        return response
+
+    async def fetch_url(self, url, evt, debug, attempt=0):
+        # One GET per URL: the headers are checked against the filters first and the
+        # body of the very same response is only streamed if they pass
+        # If the URL was downloaded before, the request is made conditional so an
+        # unchanged file costs a 304 without a body instead of a full download
+        rejection = self.get_rejection(url)
+        if rejection is not None:
+            if debug:
+                await evt.respond(f"[DEBUG] URL was rejected recently ({rejection}). Skipping.")
+            return None
 
-                extension = splitext(filename)[1]
-                mimetype = content_type
-                if mimetype is None or mimetype == 'application/octet-stream':
-                    mimetype = guess_type(filename)[0]
-                    
-                # If we couldn't get the content length, we'll need to download the file
-                file_size = int(content_length) if content_length else 0
+        cached = await self.dbm.get_attachment_by_url(url)
+        headers = {}
+        if cached is not None:
+            if cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
 
-                if debug:
-                    await evt.respond(f"[DEBUG] Filename: {filename}, Determined MIME type: {mimetype} and File_Size: {file_size}")
-
-                return {
-                    "filename": filename,
-                    "mimetype": mimetype,
-                    "extension": extension,
-                    "size": file_size
-                }
-        except Exception as e:
+        response = await self.request(url, headers, evt, debug, attempt, requeue=True)
+        if response is None:
             if debug:
-                await evt.respond(f"[DEBUG] Error in get_file_info: {str(e)}")
+                await evt.respond(f"[DEBUG] {urlsplit(url).hostname} keeps failing, its circuit breaker is open. Skipping.")
             return None
 
-    async def download_with_progress(self, session, url, evt, debug, size_limit):
+        async with response:
+            if response.status == 429:  # Too Many Requests
+                await evt.respond(f"Rate limit exceeded for URL {url} even after retrying. Skipping.")
+                await self.reject(url, "rate_limited")
+                return None
+            if response.status >= 400:
+                if debug:
+                    await evt.respond(f"[DEBUG] Server responded with HTTP {response.status}. Skipping download.")
+                await self.reject(url, "http_error")
+                return None
+
+            file_info = await self.get_file_info(response, url, evt, debug)
+            if file_info is None:
+                return None
+
+            revalidated = response.status == 304 and cached is not None
+            if revalidated:
+                file_info["mimetype"] = cached.mimetype
+                file_info["size"] = cached.size
+
+            if not (re.match(self.get_mimetype_regex(), file_info["mimetype"]) or re.match(self.get_extension_regex(), file_info["extension"])):
+                if debug:
+                    await evt.respond(f"[DEBUG] File type not allowed. Skipping download.")
+                await self.reject(url, "filtered")
+                return None
+
+            if revalidated:
+                if debug:
+                    await evt.respond(f"[DEBUG] Not modified since it was last downloaded, reusing {cached.uri}")
+                file_info["attachment"] = cached
+                return file_info, None
+
+            size_limit = self.get_upload_size()
+            if file_info["size"] > size_limit:
+                await evt.respond(f"File size ({file_info['size']} bytes) exceeds limit ({size_limit} bytes). Skipping download.")
+                await self.reject(url, "too_large")
+                return None
+
+            # Large files of known size are fetched in parts if the origin allows it,
+            # otherwise they are uploaded while they are still being downloaded. Compressed
+            # bodies are decompressed, so their Content-Length isn't the size of the upload.
+            segments = self.get_segment_count(response, file_info)
+            identity = response.headers.get("Content-Encoding", "identity").lower() == "identity"
+            stream_upload = segments == 1 and identity and 0 < self.config["stream_upload.threshold"] < file_info["size"]
+
+            # Set if the file is uploaded while it's downloaded
+            file_info["uri"] = None
+            content = await self.download_with_progress(response, url, file_info, evt, debug, size_limit, stream_upload, segments)
+            if content is None:
+                return None  # Skip further processing if download failed or was cancelled
+            file_info["size"] = content.size
+            file_info["attachment"] = None
+
+            return file_info, content
+
+    def get_segment_count(self, response, file_info) -> int:
+        # Only for large files whose bytes can be requested as ranges of the very same version
+        min_size = self.config["segmented_download.min_size"]
+        if min_size <= 0 or file_info["size"] < min_size or response.status != 200:
+            return 1
+        if response.headers.get("Accept-Ranges", "").lower() != "bytes":
+            return 1
+        if response.headers.get("Content-Encoding", "identity").lower() != "identity":
+            return 1
+        if not self.get_range_validator(file_info):
+            return 1
+        host = response.url.host or ""
+        connections = self.config["segmented_download.hosts"].get(host, self.config["segmented_download.connections"])
+        return max(1, min(connections, file_info["size"]))
+
+    def create_watchdog(self, host, expected_size):
+        # Origins known to be fast have to stay within a fraction of their usual speed,
+        # a slow trickle from them most likely means the transfer got stuck
+        min_rate = self.config["watchdog.min_rate"]
+        usual_rate = self.host_throughput.get(host)
+        if usual_rate is not None:
+            min_rate = max(min_rate, usual_rate * self.config["watchdog.relative_min_rate"])
+        return ThroughputWatchdog(min_rate, self.config["watchdog.stall_time"], self.config["watchdog.deadline"], expected_size)
+
+    async def check_sniffed_type(self, header, url, file_info, evt, debug) -> bool:
+        # The headers can be missing or lie, the first bytes of the body tell what it really is
+        sniffed = ContentSniffer.sniff(header)
+        if sniffed is None:
+            return True
+        mimetype, extension = sniffed
+        if not (re.match(self.get_mimetype_regex(), mimetype) or re.match(self.get_extension_regex(), extension)):
+            if debug:
+                await evt.respond(f"[DEBUG] Content is actually {mimetype}, which is not allowed. Stop downloading.")
+            await self.reject(url, "filtered")
+            return False
+
+        declared = (file_info["declared_mimetype"] or "").split(";")[0].strip()
+        # Audio and video share containers, the server knows better which one it is
+        audio_or_video = {declared.split("/")[0], mimetype.split("/")[0]} <= {"audio", "video"}
+        if declared in ("", "application/octet-stream", "binary/octet-stream") or not audio_or_video:
+            if debug and file_info["mimetype"] != mimetype:
+                await evt.respond(f"[DEBUG] Content is actually {mimetype}, not {file_info['mimetype']}")
+            file_info["mimetype"] = mimetype
+        return True
+
+    def get_range_validator(self, file_info) -> str | None:
+        # Ranges have to come from the same version of the file, weak ETags can't ensure that
+        etag = file_info["etag"]
+        return etag if etag and not etag.startswith("W/") else file_info["last_modified"]
+
+    async def request_range(self, url, start, end, file_info, evt, debug):
+        # The range is only sent if the file is still the same version, otherwise the whole
+        # file is, which is also what happens if there's nothing to validate the range with.
+        # Offsets refer to the raw bytes, so the range mustn't be compressed.
+        headers = {}
+        validator = self.get_range_validator(file_info)
+        if validator and (start > 0 or end is not None):
+            headers["Range"] = f"bytes={start}-{'' if end is None else end}"
+            headers["If-Range"] = validator
+            headers["Accept-Encoding"] = "identity"
+        response = await self.request(url, headers, evt, debug)
+        if response is None:
+            # Not a connection error, it's neither retried nor counted as another failure
+            raise CircuitOpen(f"Circuit breaker of {urlsplit(url).hostname} is open")
+        if response.status == 200:
+            return response
+        if response.status == 206 and response.headers.get("Content-Range", "").startswith(f"bytes {start}-"):
+            return response
+        response.release()
+        raise ValueError(f"Expected bytes {start}- of the file, got HTTP {response.status}")
+
+    async def wait_to_resume(self, attempt, error, received, evt, debug) -> None:
+        if debug:
+            await evt.respond(f"[DEBUG] Download broke off after {received} bytes ({str(error) or type(error).__name__}), resuming")
+        await asyncio.sleep(self.config["resume.delay"] * 2 ** attempt)
+
+    async def download_segments(self, response, url, file_info, buffer, watchdog, segments, evt, debug) -> bool:
+        # The response that is already streaming keeps going up to the end of the first part,
+        # the other parts are requested in parallel as byte ranges over the same session
+        size = file_info["size"]
+        boundaries = [size * i // segments for i in range(segments + 1)]
+        chunk_size = self.get_download_chunk_size()
+        source = str(response.url)
+
+        header = await response.content.read(chunk_size or 64 * 1024)
+        if not await self.check_sniffed_type(header, url, file_info, evt, debug):
+            return False
+        await buffer.preallocate(boundaries)
+        await buffer.write_part(0, header[:boundaries[1]])
+        if debug:
+            await evt.respond(f"[DEBUG] Downloading in {segments} parts")
+
+        async def read_part(index, content):
+            chunks = content.iter_chunked(chunk_size) if chunk_size > 0 else content.iter_any()
+            async for chunk in chunks:
+                remaining = buffer.remaining(index)
+                await buffer.write_part(index, chunk[:remaining])
+                stalled = watchdog.update(buffer.size)
+                if stalled is not None:
+                    raise DownloadStalled(stalled)
+                if remaining <= len(chunk):
+                    return
+            if buffer.remaining(index) > 0:
+                raise aiohttp.ClientPayloadError(f"Part {index} ended {buffer.remaining(index)} bytes early")
+
+        async def fetch_part(index, content=None):
+            # Parts that break off are resumed from where they stopped
+            end = boundaries[index + 1]
+            part = None
+            attempt = 0
+            try:
+                while True:
+                    try:
+                        if content is None:
+                            if part is not None:
+                                part.release()
+                            part = await self.request_range(source, end - buffer.remaining(index), end - 1, file_info, evt, debug)
+                            # The whole file instead of the range means it changed in the meantime
+                            if part.status != 206:
+                                raise ValueError(f"Expected part {index} of the file, got HTTP {part.status}")
+                            content = part.content
+                        await read_part(index, content)
+                        return
+                    except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                        if attempt >= self.config["resume.max_attempts"]:
+                            raise
+                        await self.wait_to_resume(attempt, e, buffer.size, evt, debug)
+                        attempt += 1
+                        content = None
+            finally:
+                if part is not None:
+                    part.release()
+
+        tasks = [asyncio.create_task(fetch_part(0, response.content))]
+        tasks += [asyncio.create_task(fetch_part(index)) for index in range(1, segments)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        await buffer.finish_parts()
+        return True
+
+    async def download_with_progress(self, response, url, file_info, evt, debug, size_limit, stream_upload=False, segments=1):
+        expected_size = file_info["size"]
+        # Large bodies are spooled to a temporary file, the caller has to close the buffer
+        buffer = DownloadBuffer(self.config["spool.threshold"], self.config["spool.directory"], expected_size,
+                                self.memory_budget, self.config["memory_budget.wait_timeout"])
+        downloaded = False
+        resumed = None
+        upload = None
         try:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=7200, connect=60)) as response:
+            if expected_size > 0:
+                await buffer.reserve(expected_size, self.config["memory_budget.wait_timeout"])
+            if debug:
+                await evt.respond(f"[DEBUG] Starting download{' to disk' if buffer.spooled else ''}")
+
+            host = urlsplit(url).hostname or ""
+            watchdog = self.create_watchdog(host, expected_size)
+            if segments > 1:
+                if not await self.download_segments(response, url, file_info, buffer, watchdog, segments, evt, debug):
+                    return None
+            else:
+                chunk_size = self.get_download_chunk_size()
+                content = response.content
+                # Only the raw bytes received so far can be skipped when resuming
+                identity = response.headers.get("Content-Encoding", "identity").lower() == "identity"
+                attempt = 0
+                # A download that breaks off continues with the rest of the file, and starts
+                # over if the file changed in the meantime
+                while True:
+                    try:
+                        if content is None:
+                            if resumed is not None:
+                                resumed.release()
+                            start = buffer.size if identity else 0
+                            resumed = await self.request_range(str(response.url), start, None, file_info, evt, debug)
+                            if resumed.status == 200 and buffer.size > 0:
+                                if debug:
+                                    await evt.respond("[DEBUG] Can't resume, starting over")
+                                buffer.reset()
+                                file_info["etag"] = resumed.headers.get("ETag")
+                                file_info["last_modified"] = resumed.headers.get("Last-Modified")
+                                identity = resumed.headers.get("Content-Encoding", "identity").lower() == "identity"
+                                watchdog = self.create_watchdog(host, int(resumed.headers.get("Content-Length", 0)))
+                                if upload is not None:
+                                    upload.cancel()  # the file is uploaded once it's downloaded instead
+                                    upload = None
+                                stream_upload = False
+                            content = resumed.content
+                        # A chunk size of 0 hands over whatever the transport has received so far
+                        chunks = content.iter_chunked(chunk_size) if chunk_size > 0 else content.iter_any()
+                        async for chunk in chunks:
+                            if buffer.size == 0:
+                                if not await self.check_sniffed_type(chunk, url, file_info, evt, debug):
+                                    return None
+                                # Only started now, so the media repository gets the sniffed type
+                                if stream_upload:
+                                    upload = StreamingUpload(self.client, file_info["size"], file_info["mimetype"], file_info["filename"])
+                            await buffer.write(chunk)
+                            if upload is not None:
+                                await upload.write(chunk)
+                            if buffer.size > size_limit:
+                                await evt.respond(f"File size exceeds limit ({size_limit} bytes). Stop downloading.")
+                                await self.reject(url, "too_large")
+                                return None
+                            stalled = watchdog.update(buffer.size)
+                            if stalled is not None:
+                                raise DownloadStalled(stalled)
+                        break
+                    except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                        if attempt >= self.config["resume.max_attempts"]:
+                            raise
+                        await self.wait_to_resume(attempt, e, buffer.size, evt, debug)
+                        attempt += 1
+                        content = None
+
+            # Very short downloads say more about latency than about throughput
+            if watchdog.elapsed >= 1:
+                self.host_throughput.record(host, watchdog.average_rate)
+
+            if upload is not None:
+                file_info["uri"] = await upload.finish()
                 if debug:
-                    await evt.respond(f"[DEBUG] Starting download")
-
-                media_data = b""
-                start_time = asyncio.get_event_loop().time()
-                async for chunk in response.content.iter_chunked(8192):
-                    media_data += chunk
-                    if len(media_data) > size_limit:
-                        await evt.respond(f"File size exceeds limit ({size_limit} bytes). Stop downloading.")
-                        return None
-                    current_time = asyncio.get_event_loop().time()
-                    if current_time - start_time > 7200:  # 2 hours
-                        await evt.respond("Download time exceeded 2 hours. Download cancelled.")
-                        return None
-
-            return media_data
+                    await evt.respond(f"[DEBUG] Streamed upload finished: {upload.uri}")
+
+            downloaded = True
+            return buffer
+        except DownloadStalled as e:
+            await evt.respond(f"Download cancelled, it {e}.")
+            await self.reject(url, "failed")
+            return None
+        except CircuitOpen as e:
+            if debug:
+                await evt.respond(f"[DEBUG] {e}, stop downloading.")
+            return None
         except asyncio.TimeoutError:
+            self.circuit_breaker.record_failure(urlsplit(url).hostname or "")
             if debug:
                 await evt.respond("[DEBUG] Connection timed out while downloading the file.")
+            await self.reject(url, "failed")
+            return None
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError) as e:
+            self.circuit_breaker.record_failure(urlsplit(url).hostname or "")
+            if debug:
+                await evt.respond(f"[DEBUG] Connection failed while downloading: {str(e)}")
             return None
         except Exception as e:
             if debug:
                 await evt.respond(f"[DEBUG] An error occurred while downloading: {str(e)}")
             return None
+        finally:
+            if resumed is not None:
+                resumed.release()
+            if not downloaded:
+                buffer.close()
+                if upload is not None:
+                    upload.cancel()
     
     def get_jpeg_size_from_bytes(self, data, evt, debug):
+        return self.get_jpeg_size_from_file(io.BytesIO(data), evt, debug)
+
+    def get_jpeg_size_from_file(self, f, evt, debug):
         try:
-            f = io.BytesIO(data)
             f.seek(0)
             size = 2
             ftype = 0
@@ -188,266 +636,368 @@ class URLDownloadBot(Plugin):
                 asyncio.create_task(evt.respond(f"[DEBUG] An Error getting picture size information: {str(e)}"))
             return None, None
         
-    async def get_upload_size(self, evt, debug):
+    def get_upload_size(self) -> int:
+        # Cached and refreshed in the background instead of asking the homeserver for every URL
+        return self.upload_size
+
+    async def refresh_upload_size(self) -> None:
         try:
             server_config = await self.client.get_media_repo_config()
 
-            if isinstance(server_config, MediaRepoConfig):
-                return int(server_config.upload_size)
-            else:
-                return 1024 * 1024 * 50
-        
+            if isinstance(server_config, MediaRepoConfig) and server_config.upload_size:
+                self.upload_size = int(server_config.upload_size)
         except Exception as e:
-            if debug:
-                await evt.respond(f"[DEBUG] An error occurred while get matrix server config: {str(e)}")
-            return 1024 * 1024 * 50
+            self.log.warning(f"Failed to get the media repository config, keeping upload limit of {self.upload_size} bytes: {e}")
 
-    async def process_url(self, group, evt, debug, relates_to_content):
-        try:
-            async with aiohttp.ClientSession() as session:
-                file_info = await self.get_file_info(session, group, evt, debug)
-                
-                if file_info is None:
-                    return
+    async def get_or_create_attachment(self, content, file_info, group, evt, debug):
+        file_size = file_info["size"]
 
-                if not (re.match(self.get_mimetype_regex(), file_info["mimetype"]) or re.match(self.get_extension_regex(), file_info["extension"])):
-                    if debug:
-                        await evt.respond(f"[DEBUG] File type not allowed. Skipping download.")
-                    return
-
-                file_size = file_info["size"]
-                size_limit = await self.get_upload_size(evt, debug)
-                content = None
-                if file_size == 0:
-                    content = await self.download_with_progress(session, group, evt, debug, size_limit)
-                    if content is None:
-                        return
-                    file_size = len(content)
+        mimetype = file_info["mimetype"]
+        is_video = mimetype.startswith('video/')
+        is_audio = mimetype.startswith('audio/') or mimetype in ['application/ogg']
+        is_image = mimetype.startswith('image/')
 
-                if file_size > size_limit:
-                    await evt.respond(f"File size ({file_size} bytes) exceeds limit ({size_limit} bytes). Skipping download.")
-                    return
-
-                # If we haven't downloaded the content yet, do it now
-                if content is None:
-                    content = await self.download_with_progress(session, group, evt, debug, size_limit)
-                    if content is None:
-                        return  # Skip further processing if download failed or was cancelled
-                    file_size = len(content)
-                
-                mimetype = file_info["mimetype"]
-                is_video = mimetype.startswith('video/')
-                is_audio = mimetype.startswith('audio/') or mimetype in ['application/ogg']
-                is_image = mimetype.startswith('image/')
-                
-                sha512sum = sha512(content).hexdigest()
-                attachment = await self.dbm.get_attachment(sha512sum)
-
-                if attachment is None:
-                    if debug:
-                        await evt.respond(f"[DEBUG] First time encountering this attachment. Postprocessing.")
-                    attachment = Attachment()
-                    attachment.sha512sum = sha512sum
-                    attachment.size = file_size
-                    attachment.mimetype = mimetype
-                    attachment.url = group
-
-                    try:
-                        # is_document = mimetype.startswith('application/') and attachment.mimetype != 'application/ogg'
-                        # # Use OpenCV Process video files
-                        if is_video:
-                            filename = file_info["filename"]
-                            # Check for (numberxnumber) pattern in the filename
-                            hw_match = re.search(r'[-_ ](\d{1,4})x(\d{1,4})', filename)
-                            if hw_match:
-                                attachment.width = int(hw_match.group(1))
-                                attachment.height = int(hw_match.group(2))
-                            # Check if filename starts with "tiktok"
-                            elif filename.lower().startswith("tiktok"):
-                                attachment.width = 1080
-                                attachment.height = 1920
-                            else:
-                                attachment.width = 1920
-                                attachment.height = 1080
-                        #     video_file = 'temp_video.mp4'
-                        #     with open(video_file, 'wb') as f:
-                        #         f.write(content)
-                        #     cap = cv2.VideoCapture(video_file)
-                        #     if cap.isOpened():
-                        #         attachment.width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-                        #         attachment.height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-                        #         # CAP_PROP_POS_MSEC 获取的是视频当前帧的时间戳，而不是视频的总时长
-                        #         # 用 CAP_PROP_FRAME_COUNT 和 CAP_PROP_FPS 计算总时长
-                        #         frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-                        #         fps = cap.get(cv2.CAP_PROP_FPS)
-                        #         if fps > 0:
-                        #             attachment.duration = int((frame_count / fps) * 1000)  # 转换为毫秒
-                        #     cap.release()
-                        
-                        # Process audio files
-                        elif is_audio:
-                            # audio_file = 'temp_audio.mp3'
-                            # with open(audio_file, 'wb') as f:
-                            #     f.write(content)
-                            # tag = TinyTag.get(audio_file)
-
-                            audio_tag = TinyTag.get(file_obj=io.BytesIO(content))
-                            if audio_tag:
-                                attachment.duration = int(audio_tag.duration * 1000)  # Convert to milliseconds
-                        
-                        # Process image files
-                        elif is_image:
-                            width, height = self.get_jpeg_size_from_bytes(content, evt, debug)
-                            if width:
-                                attachment.width = width
-                            if height:
-                                attachment.height = height
-                    
-                    except Exception as ex:
-                        if debug:
-                            await evt.respond(f"[DEBUG] An error occurred during postprocessing: {ex}")
+        # Hashed while downloading, so there's nothing left to compute here
+        sha512sum = content.sha512sum
+        attachment = await self.dbm.get_attachment(sha512sum)
 
-                    try:
-                        attachment.uri = await self.client.upload_media(
-                            data=content,
-                            mime_type=attachment.mimetype,
-                            filename=file_info["filename"],
-                            size=attachment.size
-                        )
-                        if debug:
-                            await evt.respond(f"[DEBUG] Upload File URI: {attachment.uri}")
-                        
-                        # # 获取缩略图（仅对视频、音频和文档）
-                        # if is_video or is_audio or is_document: 
-                        #     try:   
-                        #         thumbnail_process = await self.client.download_thumbnail(
-                        #             url=attachment.uri,
-                        #             width=640,
-                        #             height=480,
-                        #             resize_method="scale",
-                        #             allow_remote=None,  # 显式设置为 False，防止服务器尝试获取远程资源
-                        #             timeout_ms=10000     # 显式传递 None
-                        #         )
-                        #         attachment.thumbnail = thumbnail_process
-                        #         attachment.thumbnail_size = len(attachment.thumbnail)
-                        #         # 提取缩略图尺寸
-                        #         thumbnail_width, thumbnail_height = await self.get_jpeg_size_from_bytes(thumbnail_process, evt, debug)
-                        #         if thumbnail_width:
-                        #             attachment.thumbnail_width = thumbnail_width
-                        #         if thumbnail_height:
-                        #             attachment.thumbnail_height = thumbnail_height
-
-                        #     except Exception as e:
-                        #         if debug:
-                        #             await evt.respond(f"[DEBUG] Error generating thumbnail: {e}")
-                        
-                        # if attachment.thumbnail is not None and attachment.thumbnail_height and attachment.thumbnail_height > 0:
-                        #     attachment.thumbnail_uri = await self.client.upload_media(
-                        #         data=attachment.thumbnail,
-                        #         mime_type="image/jpeg",
-                        #         filename=f"{splitext(file_info['filename'])[0]}-thumbnail.jpg",
-                        #         size=attachment.thumbnail_size
-                        #     )
-                        #     if debug:
-                        #         await evt.respond(f"[DEBUG] Thumbnail URI: {attachment.thumbnail_uri}")
-
-                    except Exception as e:
-                        if debug:
-                            await evt.respond(f"[DEBUG] File upload failed: {str(e)}")
-                        return
-                else:
-                    if debug:
-                        await evt.respond(f"[DEBUG] Found attachment in database!")
-
-                info = None
-                message_type = None
-                    
+        if attachment is None:
+            if debug:
+                await evt.respond(f"[DEBUG] First time encountering this attachment. Postprocessing.")
+            attachment = Attachment()
+            attachment.sha512sum = sha512sum
+            attachment.size = file_size
+            attachment.mimetype = mimetype
+            attachment.url = group
+            attachment.etag = file_info["etag"]
+            attachment.last_modified = file_info["last_modified"]
+            attachment.content_length = file_size
+
+            try:
+                # is_document = mimetype.startswith('application/') and attachment.mimetype != 'application/ogg'
+                # # Use OpenCV Process video files
                 if is_video:
-                    info = VideoInfo(
-                        mimetype=attachment.mimetype,
-                        size=attachment.size,
-                        width=attachment.width if attachment.width else None,
-                        height=attachment.height if attachment.height else None,
-                        duration=int(attachment.duration) if attachment.duration else None
-                        # thumbnail_info=ThumbnailInfo(
-                        #     width=attachment.thumbnail_width if attachment.thumbnail_width else None,
-                        #     height=attachment.thumbnail_height if attachment.thumbnail_height else None,
-                        #     mimetype="image/jpeg" if attachment.thumbnail else None,
-                        #     size=attachment.thumbnail_size if attachment.thumbnail else None
-                        # ) if attachment.thumbnail else None,
-                        # thumbnail_url=attachment.thumbnail_uri if attachment.thumbnail_uri else None
-                    )
-                    message_type = MessageType.VIDEO
-
+                    filename = file_info["filename"]
+                    # Check for (numberxnumber) pattern in the filename
+                    hw_match = re.search(r'[-_ ](\d{1,4})x(\d{1,4})', filename)
+                    if hw_match:
+                        attachment.width = int(hw_match.group(1))
+                        attachment.height = int(hw_match.group(2))
+                    # Check if filename starts with "tiktok"
+                    elif filename.lower().startswith("tiktok"):
+                        attachment.width = 1080
+                        attachment.height = 1920
+                    else:
+                        attachment.width = 1920
+                        attachment.height = 1080
+                #     video_file = 'temp_video.mp4'
+                #     with open(video_file, 'wb') as f:
+                #         f.write(content)
+                #     cap = cv2.VideoCapture(video_file)
+                #     if cap.isOpened():
+                #         attachment.width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+                #         attachment.height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+                #         # CAP_PROP_POS_MSEC 获取的是视频当前帧的时间戳，而不是视频的总时长
+                #         # 用 CAP_PROP_FRAME_COUNT 和 CAP_PROP_FPS 计算总时长
+                #         frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+                #         fps = cap.get(cv2.CAP_PROP_FPS)
+                #         if fps > 0:
+                #             attachment.duration = int((frame_count / fps) * 1000)  # 转换为毫秒
+                #     cap.release()
+                
+                # Process audio files
                 elif is_audio:
-                    info = AudioInfo(
-                        mimetype=attachment.mimetype,
-                        size=attachment.size,
-                        duration=int(attachment.duration) if attachment.duration else None
-                    )
-                    message_type = MessageType.AUDIO
-
+                    # audio_file = 'temp_audio.mp3'
+                    # with open(audio_file, 'wb') as f:
+                    #     f.write(content)
+                    # tag = TinyTag.get(audio_file)
+
+                    with content.open() as f:
+                        audio_tag = TinyTag.get(file_obj=f)
+                    if audio_tag:
+                        attachment.duration = int(audio_tag.duration * 1000)  # Convert to milliseconds
+                
+                # Process image files
                 elif is_image:
-                    info = ImageInfo(
-                        mimetype=attachment.mimetype,
-                        size=attachment.size,
-                        width=attachment.width if attachment.width else None,
-                        height=attachment.height if attachment.height else None
-                        # thumbnail_info=ThumbnailInfo(
-                        #     width=attachment.thumbnail_width if attachment.thumbnail_width else None,
-                        #     height=attachment.thumbnail_height if attachment.thumbnail_height else None,
-                        #     mimetype="image/jpeg" if attachment.thumbnail else None,
-                        #     size=attachment.thumbnail_size if attachment.thumbnail else None
-                        # ) if attachment.thumbnail else None,
-                        # thumbnail_url=attachment.thumbnail_uri if attachment.thumbnail_uri else None
-                    )
-                    message_type = MessageType.IMAGE
-
-                else:
-                    info = FileInfo(
-                        mimetype=attachment.mimetype,
+                    with content.open() as f:
+                        width, height = self.get_jpeg_size_from_file(f, evt, debug)
+                    if width:
+                        attachment.width = width
+                    if height:
+                        attachment.height = height
+            
+            except Exception as ex:
+                if debug:
+                    await evt.respond(f"[DEBUG] An error occurred during postprocessing: {ex}")
+
+            try:
+                # Set if the file was already uploaded while it was downloaded
+                attachment.uri = file_info["uri"]
+                if attachment.uri is None:
+                    attachment.uri = await self.client.upload_media(
+                        # Spooled files are streamed from disk instead of being mapped into memory at once
+                        data=content.iter_chunks() if content.spooled else content.getbuffer(),
+                        mime_type=attachment.mimetype,
+                        filename=file_info["filename"],
                         size=attachment.size
-                        # thumbnail_info=ThumbnailInfo(
-                        #     width=attachment.thumbnail_width if attachment.thumbnail_width else None,
-                        #     height=attachment.thumbnail_height if attachment.thumbnail_height else None,
-                        #     mimetype="image/jpeg" if attachment.thumbnail else None,
-                        #     size=attachment.thumbnail_size if attachment.thumbnail else None
-                        # ) if attachment.thumbnail else None,
                     )
-                    message_type = MessageType.FILE
-
                 if debug:
-                    await evt.respond(f"[DEBUG] Sending file with info: {info}")
-
-                try:
-                    await self.client.send_file(
-                        room_id=evt.room_id,
-                        url=attachment.uri,
-                        info=info,
-                        file_name=file_info["filename"],
-                        file_type=message_type,
-                        relates_to=relates_to_content
-                    )
-                    await self.dbm.store_attachment(attachment)
+                    await evt.respond(f"[DEBUG] Upload File URI: {attachment.uri}")
+                # Known from now on, also if sending it fails. Reused attachments aren't stored again.
+                await self.dbm.store_attachment(attachment)
+                
+                # # 获取缩略图（仅对视频、音频和文档）
+                # if is_video or is_audio or is_document: 
+                #     try:   
+                #         thumbnail_process = await self.client.download_thumbnail(
+                #             url=attachment.uri,
+                #             width=640,
+                #             height=480,
+                #             resize_method="scale",
+                #             allow_remote=None,  # 显式设置为 False，防止服务器尝试获取远程资源
+                #             timeout_ms=10000     # 显式传递 None
+                #         )
+                #         attachment.thumbnail = thumbnail_process
+                #         attachment.thumbnail_size = len(attachment.thumbnail)
+                #         # 提取缩略图尺寸
+                #         thumbnail_width, thumbnail_height = await self.get_jpeg_size_from_bytes(thumbnail_process, evt, debug)
+                #         if thumbnail_width:
+                #             attachment.thumbnail_width = thumbnail_width
+                #         if thumbnail_height:
+                #             attachment.thumbnail_height = thumbnail_height
+
+                #     except Exception as e:
+                #         if debug:
+                #             await evt.respond(f"[DEBUG] Error generating thumbnail: {e}")
+                
+                # if attachment.thumbnail is not None and attachment.thumbnail_height and attachment.thumbnail_height > 0:
+                #     attachment.thumbnail_uri = await self.client.upload_media(
+                #         data=attachment.thumbnail,
+                #         mime_type="image/jpeg",
+                #         filename=f"{splitext(file_info['filename'])[0]}-thumbnail.jpg",
+                #         size=attachment.thumbnail_size
+                #     )
+                #     if debug:
+                #         await evt.respond(f"[DEBUG] Thumbnail URI: {attachment.thumbnail_uri}")
+
+            except Exception as e:
+                if debug:
+                    await evt.respond(f"[DEBUG] File upload failed: {str(e)}")
+                return None
+        else:
+            if debug:
+                await evt.respond(f"[DEBUG] Found attachment in database!")
+                if file_info["uri"] is not None:
+                    await evt.respond(f"[DEBUG] Reusing it instead of the streamed upload {file_info['uri']}")
 
-                except Exception as e:
-                    if debug:
-                        await evt.respond(f"[DEBUG] File sending failed: {str(e)}")                  
+        return attachment
 
+    async def process_url(self, group, evt, debug, attempt=0):
+        content = None
+        try:
+            fetched = await self.fetch_url(group, evt, debug, attempt)
+            if fetched is None:
+                return None
+            file_info, content = fetched
+            if content is None:
+                # Confirmed unchanged by the origin, nothing was downloaded
+                return file_info["attachment"], file_info
+
+            # Different URLs can point to the same file, it is only postprocessed and uploaded once
+            attachment = await self.hash_flights.run(
+                content.sha512sum,
+                lambda: self.get_or_create_attachment(content, file_info, group, evt, debug)
+            )
+            if attachment is None:
+                return None
+            # Every URL remembers its own validators, also if its file was first seen under
+            # another URL or is still the same after its validators changed
+            await self.dbm.store_url(evolve(attachment, url=group, etag=file_info["etag"], last_modified=file_info["last_modified"]))
+            return attachment, file_info
+
+        except RateLimited:
+            raise
         except aiohttp.ClientError as e:
+            if isinstance(e, aiohttp.ClientConnectionError):
+                self.circuit_breaker.record_failure(urlsplit(group).hostname or "")
             if debug:
                 await evt.respond(f"[DEBUG] Network error while processing URL {group}: {str(e)}")
+            await self.reject(group, "failed")
         except asyncio.TimeoutError:
+            self.circuit_breaker.record_failure(urlsplit(group).hostname or "")
             if debug:
                 await evt.respond(f"[DEBUG] Timeout while processing URL {group}")
+            await self.reject(group, "failed")
         except Exception as e:
             if debug:
                 await evt.respond(f"[DEBUG] An error occurred while processing URL {group}: {str(e)}")
+        finally:
+            if content is not None:
+                content.close()
+
+    async def process_job(self, job: Job) -> None:
+        await self.process_message(job.urls, job.evt, job.debug, job.relates_to)
+        if job.debug:
+            await job.evt.respond("[DEBUG] Finished processing all URLs in this message.")
+
+    async def process_message(self, urls, evt, debug, relates_to_content):
+        # URLs are downloaded and uploaded concurrently, limited per message and across
+        # all messages, but posted in the order they appear in the message
+        message_semaphore = asyncio.Semaphore(self.config["concurrency.per_message"])
+
+        async def process_limited(url):
+            # Recorded including debug output, so every message sharing the result can send
+            # the notices that apply to its own room
+            notices = NoticeRecorder()
+            host = urlsplit(url).hostname or ""
+            attempt = 0
+            while True:
+                # A rate limited host is waited for without holding a slot, so URLs of
+                # other hosts keep being downloaded in the meantime
+                await self.rate_limiter.wait_unblocked(host)
+                async with message_semaphore, self.download_semaphore:
+                    if attempt == 0:
+                        await self.dbm.claim_job(evt.room_id, evt.event_id, url)
+                    try:
+                        return await self.process_url(url, notices, True, attempt), notices
+                    except RateLimited as e:
+                        attempt = e.attempt
+
+        # A URL that is already being processed for another message or room isn't
+        # downloaded again, the result is shared and each message posts it on its own
+        tasks = [
+            asyncio.create_task(self.url_flights.run(self.normalize_url(url), lambda url=url: process_limited(url)))
+            for url in urls
+        ]
+        try:
+            for url, task in zip(urls, tasks):
+                processed, notices = await task
+                await notices.replay(evt, debug)
+                if processed is not None:
+                    attachment, file_info = processed
+                    await self.send_attachment(attachment, file_info, evt, debug, relates_to_content)
+                await self.dbm.complete_job(evt.room_id, evt.event_id, url)
+        finally:
+            # Don't leave downloads running when the worker is cancelled on shutdown
+            for task in tasks:
+                task.cancel()
+
+    async def send_attachment(self, attachment, file_info, evt, debug, relates_to_content):
+        mimetype = attachment.mimetype
+        is_video = mimetype.startswith('video/')
+        is_audio = mimetype.startswith('audio/') or mimetype in ['application/ogg']
+        is_image = mimetype.startswith('image/')
+
+        info = None
+        message_type = None
+
+        if is_video:
+            info = VideoInfo(
+                mimetype=attachment.mimetype,
+                size=attachment.size,
+                width=attachment.width if attachment.width else None,
+                height=attachment.height if attachment.height else None,
+                duration=int(attachment.duration) if attachment.duration else None
+                # thumbnail_info=ThumbnailInfo(
+                #     width=attachment.thumbnail_width if attachment.thumbnail_width else None,
+                #     height=attachment.thumbnail_height if attachment.thumbnail_height else None,
+                #     mimetype="image/jpeg" if attachment.thumbnail else None,
+                #     size=attachment.thumbnail_size if attachment.thumbnail else None
+                # ) if attachment.thumbnail else None,
+                # thumbnail_url=attachment.thumbnail_uri if attachment.thumbnail_uri else None
+            )
+            message_type = MessageType.VIDEO
+
+        elif is_audio:
+            info = AudioInfo(
+                mimetype=attachment.mimetype,
+                size=attachment.size,
+                duration=int(attachment.duration) if attachment.duration else None
+            )
+            message_type = MessageType.AUDIO
+
+        elif is_image:
+            info = ImageInfo(
+                mimetype=attachment.mimetype,
+                size=attachment.size,
+                width=attachment.width if attachment.width else None,
+                height=attachment.height if attachment.height else None
+                # thumbnail_info=ThumbnailInfo(
+                #     width=attachment.thumbnail_width if attachment.thumbnail_width else None,
+                #     height=attachment.thumbnail_height if attachment.thumbnail_height else None,
+                #     mimetype="image/jpeg" if attachment.thumbnail else None,
+                #     size=attachment.thumbnail_size if attachment.thumbnail else None
+                # ) if attachment.thumbnail else None,
+                # thumbnail_url=attachment.thumbnail_uri if attachment.thumbnail_uri else None
+            )
+            message_type = MessageType.IMAGE
+
+        else:
+            info = FileInfo(
+                mimetype=attachment.mimetype,
+                size=attachment.size
+                # thumbnail_info=ThumbnailInfo(
+                #     width=attachment.thumbnail_width if attachment.thumbnail_width else None,
+                #     height=attachment.thumbnail_height if attachment.thumbnail_height else None,
+                #     mimetype="image/jpeg" if attachment.thumbnail else None,
+                #     size=attachment.thumbnail_size if attachment.thumbnail else None
+                # ) if attachment.thumbnail else None,
+            )
+            message_type = MessageType.FILE
+
+        if debug:
+            await evt.respond(f"[DEBUG] Sending file with info: {info}")
+
+        try:
+            await self.client.send_file(
+                room_id=evt.room_id,
+                url=attachment.uri,
+                info=info,
+                file_name=file_info["filename"],
+                file_type=message_type,
+                relates_to=relates_to_content
+            )
+            await self.dbm.record_usage(attachment.sha512sum, evt.room_id)
+
+        except Exception as e:
+            if debug:
+                await evt.respond(f"[DEBUG] File sending failed: {str(e)}")
+
+    def get_relates_to(self, evt):
+        if evt.content.relates_to and evt.content.relates_to.rel_type == RelationType.THREAD:
+            return RelatesTo(
+                rel_type=RelationType.THREAD,
+                event_id=EventID(evt.content.relates_to.event_id),
+                is_falling_back=True,
+                in_reply_to=InReplyTo(
+                    event_id=EventID(evt.event_id)
+                )
+            )
+        return None
+
+    async def resume_jobs(self) -> None:
+        jobs = {}
+        for row in await self.dbm.get_unfinished_jobs(self.config["queue.max_attempts"]):
+            jobs.setdefault((row["room_id"], row["event_id"]), []).append(row["url"])
+
+        for (room_id, event_id), urls in jobs.items():
+            try:
+                evt = MessageEvent(await self.client.get_event(room_id, event_id), self.client)
+                debug = await self.dbm.is_debug_in_room(room_id)
+                job = Job(evt=evt, urls=urls, debug=debug, relates_to=self.get_relates_to(evt))
+            except Exception:
+                self.log.exception(f"Failed to restore job for {event_id} in {room_id}, keeping it for the next start")
+                job = None
+            # Jobs that can't be restored or queued right now, e.g. because the homeserver
+            # isn't reachable yet, are kept until queue.max_attempts gives up on them
+            if job is None or not self.job_queue.submit(job):
+                await self.dbm.postpone_jobs(room_id, event_id)
+        if jobs:
+            self.log.info(f"Resumed {len(jobs)} unfinished job(s)")
 
     @event.on(EventType.ROOM_MESSAGE)
     async def handle_message(self, evt: MessageEvent) -> None:
-        enabled = await self.dbm.is_enabled_in_room(evt.room_id)
-        debug = await self.dbm.is_debug_in_room(evt.room_id)
+        enabled, debug = await self.dbm.get_room_status(evt.room_id)
         if evt.sender != enabled and self.is_whitelisted(evt.sender):
             body = evt.content.body
              # body = evt.content.formatted_body if "formatted_body" in evt.content else None
@@ -455,23 +1005,19 @@ class URLDownloadBot(Plugin):
             #     body = evt.content.body
             # else:
             #     body = html.unescape(body)
-            m = set(re.findall(self.get_url_regex(), body))
+            # dict keeps the order of appearance while dropping duplicates
+            m = list(dict.fromkeys(re.findall(self.get_url_regex(), body)))
             if debug:
                 await evt.respond(f"[DEBUG] Found URL(s): {str(m)}")
             
-            relates_to_content = None
-            if evt.content.relates_to and evt.content.relates_to.rel_type == RelationType.THREAD:
-                relates_to_content = RelatesTo(
-                    rel_type=RelationType.THREAD,
-                    event_id=EventID(evt.content.relates_to.event_id),
-                    is_falling_back=True,
-                    in_reply_to=InReplyTo(
-                        event_id=EventID(evt.event_id)
-                    )
-                )
-            
-            for group in m:
-                await self.process_url(group, evt, debug, relates_to_content)
-
-            if debug:
-                await evt.respond("[DEBUG] Finished processing all URLs in this message.")
\ No newline at end of file
+            if not m:
+                return
+            # The jobs are persisted first so they can be resumed if we're restarted before
+            # the queue got to them, the actual work then happens in the job queue
+            await self.dbm.enqueue_jobs(evt.room_id, evt.event_id, m)
+            if not self.job_queue.submit(Job(evt=evt, urls=m, debug=debug, relates_to=self.get_relates_to(evt))):
+                for url in m:
+                    await self.dbm.complete_job(evt.room_id, evt.event_id, url)
+                await evt.respond("Too many downloads are queued right now, please try again later.")
+            elif debug:
+                await evt.respond(f"[DEBUG] Queued {len(m)} URL(s), queue depth: {self.job_queue.depth}/{self.job_queue.max_size}")
\ No newline at end of file
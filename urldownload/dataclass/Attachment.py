@@ -17,6 +17,9 @@ class Attachment:
     thumbnail_height: int = 0
     thumbnail_size: int = 0
     url: str = ''
+    etag: str | None = None
+    last_modified: str | None = None
+    content_length: int | None = None
 
 
     @classmethod
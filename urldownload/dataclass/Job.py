@@ -0,0 +1,11 @@
+from attr import dataclass
+from maubot import MessageEvent
+from mautrix.types import RelatesTo
+
+
+@dataclass
+class Job:
+    evt: MessageEvent
+    urls: list[str]
+    debug: bool = False
+    relates_to: RelatesTo | None = None
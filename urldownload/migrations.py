@@ -39,4 +39,166 @@ async def upgrade_v3(conn: Connection) -> None:
         ALTER TABLE attachment
         ADD COLUMN url TEXT NOT NULL
     """
-    )
\ No newline at end of file
+    )
+
+@upgrade_table.register(description="Persist download jobs so they survive restarts")
+async def upgrade_v4(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE IF NOT EXISTS job (
+            room_id TEXT NOT NULL,
+            event_id TEXT NOT NULL,
+            url TEXT NOT NULL,
+            position INTEGER NOT NULL DEFAULT 0,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at BIGINT NOT NULL,
+            updated_at BIGINT NOT NULL,
+            PRIMARY KEY (room_id, event_id, url)
+        )"""
+    )
+
+
+@upgrade_table.register(description="Keep HTTP validators to revalidate known URLs")
+async def upgrade_v5(conn: Connection) -> None:
+    await conn.execute("ALTER TABLE attachment ADD COLUMN etag TEXT")
+    await conn.execute("ALTER TABLE attachment ADD COLUMN last_modified TEXT")
+    await conn.execute("ALTER TABLE attachment ADD COLUMN content_length BIGINT")
+    await conn.execute("CREATE INDEX IF NOT EXISTS attachment_url_idx ON attachment (url)")
+
+
+@upgrade_table.register(description="Remember rejected URLs for a while")
+async def upgrade_v6(conn: Connection) -> None:
+    await conn.execute(
+        """CREATE TABLE IF NOT EXISTS rejected_url (
+            url TEXT PRIMARY KEY,
+            reason TEXT NOT NULL,
+            expires_at BIGINT NOT NULL,
+            fingerprint TEXT NOT NULL
+        )"""
+    )
+
+
+@upgrade_table.register(description="Track how often attachments are used and in which rooms")
+async def upgrade_v7(conn: Connection) -> None:
+    await conn.execute("ALTER TABLE attachment ADD COLUMN hit_count INTEGER NOT NULL DEFAULT 0")
+    await conn.execute("ALTER TABLE attachment ADD COLUMN last_used BIGINT")
+    await conn.execute(
+        """CREATE TABLE IF NOT EXISTS attachment_room (
+            sha512sum TEXT NOT NULL,
+            room_id TEXT NOT NULL,
+            hit_count INTEGER NOT NULL DEFAULT 0,
+            last_used BIGINT NOT NULL,
+            PRIMARY KEY (sha512sum, room_id)
+        )"""
+    )
+
+
+# Rows copied per batch when a table is rebuilt
+BATCH_SIZE = 1000
+
+
+async def copy_with_binary_digest(conn: Connection, source: str, target: str, key: list[str], columns: list[str]) -> None:
+    # Pages through the source by its primary key, so each batch is a range scan and
+    # only one batch is held in memory at a time
+    placeholders = ", ".join(f"${i}" for i in range(1, len(key) + 1))
+    select = f"""
+        SELECT {", ".join(key + columns)}
+        FROM {source}
+        WHERE ({", ".join(key)}) > ({placeholders})
+        ORDER BY {", ".join(key)}
+        LIMIT {BATCH_SIZE}
+    """
+    target_columns = ["digest"] + key[1:] + columns
+    insert = f"""
+        INSERT INTO {target} ({", ".join(target_columns)})
+        VALUES ({", ".join(f"${i}" for i in range(1, len(target_columns) + 1))})
+    """
+    last = ["" for _ in key]
+    while rows := await conn.fetch(select, *last):
+        await conn.executemany(insert, [
+            (bytes.fromhex(row["sha512sum"]), *(row[column] for column in key[1:] + columns))
+            for row in rows
+        ])
+        last = [rows[-1][column] for column in key]
+
+
+@upgrade_table.register(description="Store attachment digests as bytes instead of hex")
+async def upgrade_v8(conn: Connection, scheme: Scheme) -> None:
+    # Halves the size of the primary key. SQLite can't change a primary key in place,
+    # so the tables are rebuilt on both databases and the rows copied over in batches
+    binary = "BLOB" if scheme == Scheme.SQLITE else "BYTEA"
+    await conn.execute(
+        f"""CREATE TABLE attachment_v8 (
+            digest {binary} PRIMARY KEY,
+            uri TEXT NOT NULL,
+            mimetype TEXT NOT NULL,
+            size BIGINT NOT NULL,
+            thumbnail_uri TEXT,
+            width INTEGER,
+            height INTEGER,
+            duration NUMERIC,
+            thumbnail_width INTEGER,
+            thumbnail_height INTEGER,
+            thumbnail_size INTEGER,
+            url TEXT NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            content_length BIGINT,
+            hit_count INTEGER NOT NULL DEFAULT 0,
+            last_used BIGINT
+        )"""
+    )
+    await conn.execute(
+        f"""CREATE TABLE attachment_room_v8 (
+            digest {binary} NOT NULL,
+            room_id TEXT NOT NULL,
+            hit_count INTEGER NOT NULL DEFAULT 0,
+            last_used BIGINT NOT NULL,
+            PRIMARY KEY (digest, room_id)
+        )"""
+    )
+    await copy_with_binary_digest(conn, "attachment", "attachment_v8", ["sha512sum"], [
+        "uri", "mimetype", "size", "thumbnail_uri", "width", "height", "duration", "thumbnail_width",
+        "thumbnail_height", "thumbnail_size", "url", "etag", "last_modified", "content_length", "hit_count",
+        "last_used"
+    ])
+    await copy_with_binary_digest(conn, "attachment_room", "attachment_room_v8", ["sha512sum", "room_id"], [
+        "hit_count", "last_used"
+    ])
+    await conn.execute("DROP TABLE attachment_room")
+    await conn.execute("DROP TABLE attachment")
+    await conn.execute("ALTER TABLE attachment_v8 RENAME TO attachment")
+    await conn.execute("ALTER TABLE attachment_room_v8 RENAME TO attachment_room")
+    # The URL index went away with the old table
+    await conn.execute("CREATE INDEX IF NOT EXISTS attachment_url_idx ON attachment (url)")
+
+
+@upgrade_table.register(description="Keep the validators of every URL a known file was downloaded from")
+async def upgrade_v9(conn: Connection, scheme: Scheme) -> None:
+    # The same file can be served by several URLs, each with validators of its own
+    binary = "BLOB" if scheme == Scheme.SQLITE else "BYTEA"
+    await conn.execute(
+        f"""CREATE TABLE IF NOT EXISTS attachment_url (
+            url TEXT PRIMARY KEY,
+            digest {binary} NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            updated_at BIGINT NOT NULL
+        )"""
+    )
+    await conn.execute("CREATE INDEX IF NOT EXISTS attachment_url_digest_idx ON attachment_url (digest)")
+    # Every URL starts out with the attachment most recently used for it
+    await conn.execute(
+        """INSERT INTO attachment_url (url, digest, etag, last_modified, updated_at)
+        SELECT url, digest, etag, last_modified, COALESCE(last_used, 0)
+        FROM attachment a
+        WHERE NOT EXISTS (
+            SELECT 1 FROM attachment b
+            WHERE b.url = a.url AND (
+                COALESCE(b.last_used, 0) > COALESCE(a.last_used, 0)
+                OR (COALESCE(b.last_used, 0) = COALESCE(a.last_used, 0) AND b.digest > a.digest)
+            )
+        )"""
+    )
+    # URLs are looked up in attachment_url from now on
+    await conn.execute("DROP INDEX IF EXISTS attachment_url_idx")